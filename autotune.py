@@ -0,0 +1,82 @@
+import torch
+
+# -----------------------------------------------------------------------------
+# picks the micro batch size and activation checkpointing policy for a memory budget
+
+def checkpoint_policies(n_layer):
+    # from no recompute to full recompute: 0 (none), every 4th, every 2nd, every layer
+    return [0] + [every for every in (4, 2, 1) if every <= n_layer]
+
+def num_params(config):
+    C, L = config.n_embd, config.n_layer
+    per_layer = 12*C*C + 13*C # c_attn, attn c_proj, c_fc, mlp c_proj and both layernorms
+    return config.vocab_size*C + config.block_size*C + L*per_layer + 2*C # lm_head is tied to wte
+
+def estimate_step_memory(config, B, T, checkpoint_every=0, act_bytes=4, loss_chunk=0):
+    """
+    Rough peak bytes of one training micro step with AdamW, act_bytes is 2 under bf16 autocast.
+    - weights, grads and the two fp32 AdamW moments: 16 bytes per parameter
+    - a block keeps ~17 activations of width C per token for backward (layernorm and matmul
+      inputs, q/k/v and the attention output, the 4C MLP hidden before and after gelu)
+    - a checkpointed block keeps only its fp32 input, plus one block's activations live during recompute
+    - the logits, their fp32 softmax and their gradient, each B*T*vocab_size, or loss_chunk*vocab_size
+      with a chunked loss, which only holds one chunk's logits at a time
+    """
+    C, L, V = config.n_embd, config.n_layer, config.vocab_size
+    tokens = B * T
+    states = 16 * num_params(config)
+    if getattr(config, "mask_buffer", True):
+        states += L * config.block_size**2 * 4
+    block_acts = tokens * C * 17 * act_bytes
+    checkpointed = sum(1 for i in range(L) if checkpoint_every and i % checkpoint_every == 0)
+    acts = (L - checkpointed) * block_acts + checkpointed * tokens * C * 4
+    if checkpointed:
+        acts += block_acts
+    logits = (min(tokens, loss_chunk) if loss_chunk else tokens) * V * (act_bytes + 4 + 4)
+    return states + acts + logits
+
+@torch.no_grad()
+def _zero_grads(model):
+    for p in model.parameters():
+        p.grad = None
+
+def measure_step_memory(model, B, T, checkpoint_every, device, autocast_dtype=None, loss_chunk=0):
+    """Peak bytes allocated by one forward/backward on cuda, plus the AdamW moments that
+    the measurement does not allocate. Only cuda has allocator statistics to measure with."""
+    model.set_activation_checkpointing(checkpoint_every)
+    model.train()
+    _zero_grads(model)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    x = torch.randint(0, model.config.vocab_size, (B, T), device=device)
+    try:
+        with torch.autocast(device_type="cuda", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            _, loss = model(x, x, loss_chunk=loss_chunk)
+        loss.backward()
+        peak = torch.cuda.max_memory_allocated(device)
+    except torch.OutOfMemoryError:
+        peak = float("inf")
+    _zero_grads(model)
+    torch.cuda.empty_cache()
+    return peak + 8 * sum(p.numel() for p in model.parameters())
+
+def plan_micro_batch(config, T, total_batch_size, world_size, memory_budget, measure=None, act_bytes=4, loss_chunk=0):
+    """
+    Returns (B, checkpoint_every, grad_accum_steps): the largest power of two micro batch that
+    divides the per-rank batch and fits memory_budget bytes with some checkpointing policy, and
+    for that B the policy with the least recompute that fits. measure(B, every) -> bytes
+    replaces the analytic estimate when given.
+    """
+    assert total_batch_size % (T * world_size) == 0, "total_batch_size must be divisible by T * world size"
+    rows = total_batch_size // (T * world_size) # sequences per rank per optimizer step
+    if measure is None:
+        measure = lambda B, every: estimate_step_memory(config, B, T, every, act_bytes, loss_chunk)
+    B = 1
+    while B * 2 <= rows and rows % (B * 2) == 0:
+        B *= 2
+    while B >= 1:
+        for every in checkpoint_policies(config.n_layer):
+            if measure(B, every) <= memory_budget:
+                return B, every, rows // B
+        B //= 2
+    raise ValueError(f"even B=1 with full activation checkpointing does not fit in {memory_budget/2**30:.2f} GB")
@@ -0,0 +1,69 @@
+import time
+import multiprocessing as mp
+import torch
+from gpttrainer import GPT, ModelConfig, compile_model
+
+# forward/backward latency and memory of the GPT execution modes on CPU
+# usage: python bench_compile.py --settings 4,256,2 8,512,4 --modes eager,eager-nomask,compile
+
+MODES = {
+    # name: (mask_buffer, compile, compile mode)
+    "eager": (True, False, None),
+    "eager-nomask": (False, False, None),
+    "compile": (False, True, "default"),
+    "compile-max-autotune": (False, True, "max-autotune-no-cudagraphs"),
+}
+
+def read_hwm_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def run(mode, B, T, n_layer, n_embd, block_size, steps, dynamic, queue):
+    mask_buffer, use_compile, compile_mode = MODES[mode]
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(block_size=block_size, vocab_size=50304, n_layer=n_layer, n_head=n_embd // 64, n_embd=n_embd, mask_buffer=mask_buffer))
+    buffer_mb = sum(b.numel() * b.element_size() for b in model.buffers()) / 2**20
+    if use_compile:
+        model = compile_model(model, compile_mode, dynamic)
+    x = torch.randint(0, 50304, (B, T))
+    y = torch.randint(0, 50304, (B, T))
+    t0 = time.time()
+    logits, loss = model(x, y) # warmup, includes compilation
+    loss.backward()
+    warmup = time.time() - t0
+    fwd = bwd = 0.0
+    for _ in range(steps):
+        t0 = time.time()
+        logits, loss = model(x, y)
+        t1 = time.time()
+        loss.backward()
+        t2 = time.time()
+        fwd += t1 - t0
+        bwd += t2 - t1
+    queue.put(dict(fwd_ms=1000*fwd/steps, bwd_ms=1000*bwd/steps, warmup_s=warmup, buffer_mb=buffer_mb, peak_mb=read_hwm_mb()))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settings", type=str, nargs="+", default=["4,128,2", "4,256,4", "8,256,4"], help="B,T,n_layer triples")
+    parser.add_argument("--modes", type=str, default="eager,eager-nomask,compile")
+    parser.add_argument("--n_embd", type=int, default=256)
+    parser.add_argument("--block_size", type=int, default=1024, help="sets the size of the attn.bias buffer")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--dynamic", type=str, default="false", choices=["auto", "true", "false"])
+    args = parser.parse_args()
+
+    dynamic = {"auto": None, "true": True, "false": False}[args.dynamic]
+    ctx = mp.get_context("spawn") # fresh process per run, so the peak memory numbers are per mode
+    for setting in args.settings:
+        B, T, n_layer = (int(v) for v in setting.split(","))
+        for mode in args.modes.split(","):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run, args=(mode, B, T, n_layer, args.n_embd, args.block_size, args.steps, dynamic, queue))
+            p.start()
+            r = queue.get()
+            p.join()
+            print(f"B={B:3d} T={T:5d} n_layer={n_layer:3d} | {mode:>22s} | fwd {r['fwd_ms']:8.1f} ms | bwd {r['bwd_ms']:8.1f} ms | warmup {r['warmup_s']:6.1f} s | buffers {r['buffer_mb']:7.1f} MB | peak rss {r['peak_mb']:7.0f} MB")
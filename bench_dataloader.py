@@ -0,0 +1,154 @@
+import os
+import time
+import tempfile
+import statistics
+import multiprocessing as mp
+import numpy as np
+
+# measures DataLoaderLite memory and shard switch cost on synthetic shards, and the
+# steady-state batch wait time of PrefetchLoader against the synchronous loader, and the
+# throughput of MixtureLoader's shuffled weighted rows against DataLoaderLite's sequential batches
+# usage: python bench_dataloader.py --mode memory --shard_sizes 1000000,10000000,50000000
+#        python bench_dataloader.py --mode prefetch --compute_ms 20
+#        python bench_dataloader.py --mode mixture --shard_sizes 10000000 --text input.txt
+
+def write_synthetic_shards(root, num_shards, shard_size, vocab_size=50257, seed=0):
+    # random uint16 tokens laid out like the fineweb.py output, shard 0 is val
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(num_shards):
+        split = "val" if i == 0 else "train"
+        tokens = rng.integers(0, vocab_size, size=shard_size, dtype=np.uint16)
+        np.save(os.path.join(root, f"edufineweb_{split}_{i:06d}"), tokens)
+    return root
+
+def read_status(key):
+    # value in kB from /proc/self/status, e.g. RssAnon or VmHWM
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+    return 0
+
+def run_loader(data_root, B, T, num_batches, queue):
+    from gpttrainer import DataLoaderLite
+    anon_start = read_status("RssAnon")
+    loader = DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=data_root)
+    switch_times = []
+    anon_peak = anon_start
+    t0 = time.time()
+    for i in range(num_batches):
+        shard = loader.current_shard
+        t = time.time()
+        x, y = loader.next_batch()
+        if loader.current_shard != shard:
+            switch_times.append(time.time() - t)
+        if i % 50 == 0:
+            anon_peak = max(anon_peak, read_status("RssAnon"))
+    dt = time.time() - t0
+    queue.put(dict(batches_per_sec=num_batches/dt, switches=len(switch_times),
+                   switch_ms=1000*float(np.mean(switch_times)) if switch_times else 0.0,
+                   anon_growth_mb=(anon_peak - anon_start)/1024, hwm_mb=read_status("VmHWM")/1024))
+
+def run_prefetch(data_root, B, T, num_batches, compute_ms, depth, warmup=20, make_loader=None):
+    # every step waits on a batch and then burns compute_ms of torch work, like a training micro step
+    import torch
+    from gpttrainer import DataLoaderLite, PrefetchLoader
+    if make_loader is None:
+        make_loader = lambda: DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=data_root)
+    a = torch.randn(256, 256)
+    t = time.time()
+    n = 0
+    while time.time() - t < 0.2:
+        a @ a
+        n += 1
+    matmuls = max(1, int(n * compute_ms / 200))
+    results = {}
+    for name in ["sync", "prefetch"]:
+        loader = make_loader()
+        if name == "prefetch":
+            loader = PrefetchLoader(loader, device="cpu", depth=depth)
+        wait = 0.0
+        t0 = time.time()
+        for i in range(warmup + num_batches):
+            if i == warmup:
+                wait = 0.0
+                t0 = time.time()
+            tw = time.time()
+            x, y = loader.next_batch()
+            wait += time.time() - tw
+            for _ in range(matmuls):
+                a @ a
+        results[name] = (1000*wait/num_batches, 1000*(time.time() - t0)/num_batches)
+        if name == "prefetch":
+            loader.close()
+    return results
+
+def run_mixture(data_root, text, B, T, num_batches, compute_ms, depth, repeats=5):
+    # batches/sec of each loader, the median of a few passes over the same warm page cache taken in turns
+    # (so a slow spell of the machine hits every loader alike), and its batch wait behind a PrefetchLoader
+    # with compute_ms of work per step
+    from gpttrainer import DataLoaderLite, MixtureLoader
+    loaders = {
+        "sequential": lambda: DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=data_root),
+        "mixture 1 source": lambda: MixtureLoader(B, T, 0, 1, [(data_root, 1.0)]),
+    }
+    if text:
+        loaders["mixture 0.9/0.1 +text"] = lambda: MixtureLoader(B, T, 0, 1, [(data_root, 0.9), (text, 0.1)])
+    rates, last = {name: [] for name in loaders}, {}
+    for _ in range(repeats):
+        for name, make in loaders.items():
+            loader = last[name] = make()
+            loader.next_batch() # setup left out: DataLoaderLite's is in its constructor, MixtureLoader's in its first plan
+            t0 = time.time()
+            for i in range(num_batches):
+                loader.next_batch()
+            rates[name].append(num_batches / (time.time() - t0))
+    results = {}
+    for name, make in loaders.items():
+        wait_ms, _ = run_prefetch(data_root, B, T, min(num_batches, 200), compute_ms, depth, make_loader=make)["prefetch"]
+        results[name] = (statistics.median(rates[name]), wait_ms, last[name].describe() if isinstance(last[name], MixtureLoader) else "")
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="memory", choices=["memory", "prefetch", "mixture"])
+    parser.add_argument("--shard_sizes", type=str, default="1000000,10000000,50000000")
+    parser.add_argument("--num_shards", type=int, default=3)
+    parser.add_argument("--B", type=int, default=16)
+    parser.add_argument("--T", type=int, default=1024)
+    parser.add_argument("--num_batches", type=int, default=2000)
+    parser.add_argument("--compute_ms", type=float, default=20.0, help="simulated compute per batch in prefetch mode")
+    parser.add_argument("--depth", type=int, default=4, help="prefetch queue depth")
+    parser.add_argument("--text", type=str, default="", help="text file mixed in as a second source in mixture mode")
+    args = parser.parse_args()
+
+    if args.mode == "mixture":
+        with tempfile.TemporaryDirectory() as root:
+            write_synthetic_shards(root, args.num_shards, int(args.shard_sizes.split(",")[0]))
+            results = run_mixture(root, args.text, args.B, args.T, args.num_batches, args.compute_ms, args.depth)
+        for name, (batches_per_sec, wait_ms, mixture) in results.items():
+            print(f"{name:>22s} | {batches_per_sec:8.1f} batches/s | {batches_per_sec*args.B*args.T/1e6:6.1f}M tokens/s | "
+                  f"prefetched batch wait {wait_ms:.3f} ms" + (f" | {mixture}" if mixture else ""))
+        exit(0)
+
+    if args.mode == "prefetch":
+        with tempfile.TemporaryDirectory() as root:
+            shard_size = int(args.shard_sizes.split(",")[0])
+            write_synthetic_shards(root, args.num_shards, shard_size)
+            results = run_prefetch(root, args.B, args.T, min(args.num_batches, 200), args.compute_ms, args.depth)
+        for name, (wait_ms, step_ms) in results.items():
+            print(f"{name:>8s} | batch wait {wait_ms:7.3f} ms | step {step_ms:7.2f} ms")
+        exit(0)
+
+    ctx = mp.get_context("spawn") # fresh process per run so the memory numbers don't leak across sizes
+    for shard_size in [int(s) for s in args.shard_sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as root:
+            write_synthetic_shards(root, args.num_shards, shard_size)
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_loader, args=(root, args.B, args.T, args.num_batches, queue))
+            p.start()
+            r = queue.get()
+            p.join()
+        print(f"shard {shard_size:>11,d} tokens | {r['batches_per_sec']:8.1f} batches/s | {r['switches']} switches, {r['switch_ms']:.3f} ms each | anon rss growth {r['anon_growth_mb']:.1f} MB | peak rss {r['hwm_mb']:.0f} MB")
@@ -0,0 +1,39 @@
+import time
+import torch
+from gpttrainer import GPT, ModelConfig
+
+# compares KV-cache incremental decoding against the full recompute path on CPU
+# usage: python bench_generate.py
+
+def run(model, prompt, n, use_cache, seed=42):
+    rng = torch.Generator(device="cpu")
+    rng.manual_seed(seed)
+    t0 = time.time()
+    out = model.generate(prompt, n, top_k=50, generator=rng, use_cache=use_cache)
+    return out, time.time() - t0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=6)
+    parser.add_argument("--n_head", type=int, default=6)
+    parser.add_argument("--n_embd", type=int, default=384)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--prompt_len", type=int, default=8)
+    parser.add_argument("--lengths", type=str, default="32,64,128,256")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    lengths = [int(l) for l in args.lengths.split(",")]
+    config = ModelConfig(block_size=args.prompt_len + max(lengths), vocab_size=50304,
+                         n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd)
+    model = GPT(config)
+    model.eval()
+    prompt = torch.randint(0, config.vocab_size, (args.batch_size, args.prompt_len))
+
+    for n in lengths:
+        full, t_full = run(model, prompt, n, use_cache=False)
+        cached, t_cached = run(model, prompt, n, use_cache=True)
+        match = torch.equal(full, cached)
+        tokens = args.batch_size * n
+        print(f"new tokens {n:5d} | full {tokens/t_full:9.1f} tok/s | kv cache {tokens/t_cached:9.1f} tok/s | speedup {t_full/t_cached:5.2f}x | match {match}")
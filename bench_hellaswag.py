@@ -0,0 +1,57 @@
+import time
+import random
+import torch
+from gpttrainer import GPT, ModelConfig, get_most_likely_row
+from hellaswag import CachedExamples, collate_examples, evaluate_batched
+
+# compares the batched HellaSwag engine against the one-example-per-forward path on CPU
+# usage: python bench_hellaswag.py --num_examples 200 (synthetic examples)
+#        python bench_hellaswag.py --split val (real examples, downloads the jsonl)
+
+def synthetic_datas(n, vocab_size, seed=0):
+    # random examples with the same shape statistics as HellaSwag: ~30 context and ~15 ending tokens
+    rng = random.Random(seed)
+    datas = []
+    for _ in range(n):
+        ctx = [rng.randrange(vocab_size) for _ in range(rng.randint(10, 60))]
+        endings = [[rng.randrange(vocab_size) for _ in range(rng.randint(5, 30))] for _ in range(4)]
+        datas.append({"label": rng.randrange(4), "ctx_tokens": ctx, "ending_tokens": endings})
+    return datas
+
+@torch.no_grad()
+def evaluate_per_example(model, datas):
+    preds_norm = []
+    t0 = time.time()
+    for data in datas:
+        tokens, mask = collate_examples([data]) # same padded 4xN rows as render_example
+        logits, _ = model(tokens)
+        preds_norm.append(get_most_likely_row(tokens, mask, logits))
+    return preds_norm, len(datas) / (time.time() - t0)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", type=str, default=None, help="use real HellaSwag examples from this split")
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--max_tokens", type=int, default=0, help="padded tokens per batched forward, 0 for evaluate_batched's default")
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--n_embd", type=int, default=256)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(block_size=1024, vocab_size=50304, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd))
+    model.eval()
+    if args.split is not None:
+        examples = CachedExamples(args.split)
+        datas = [examples[i] for i in range(min(args.num_examples, len(examples)))]
+    else:
+        datas = synthetic_datas(args.num_examples, 50257)
+
+    preds_norm, eps = evaluate_per_example(model, datas)
+    result = evaluate_batched(lambda tokens: model(tokens)[0], datas, "cpu", max_tokens=args.max_tokens or None)
+    labels = [data["label"] for data in datas]
+    correct = sum(int(p == l) for p, l in zip(preds_norm, labels))
+    print(f"per-example | acc_norm {correct}/{len(datas)} | {eps:.1f} examples/sec")
+    print(f"batched     | acc_norm {result['num_correct_norm']}/{len(datas)} | {result['examples_per_sec']:.1f} examples/sec")
+    print(f"predictions match: {preds_norm == result['preds_norm']}")
@@ -0,0 +1,59 @@
+import time
+import multiprocessing as mp
+
+# load time and peak rss of GPT.from_pretrained: the HF copy path against the meta device + mmap path
+# on the cached native file (converted once beforehand, its time is reported separately),
+# and of a trainer checkpoint: full torch.load + init + load_state_dict against GPT.from_checkpoint
+# every load runs in a fresh process, the page cache is warm for both after the first read
+# usage: python bench_load.py --models gpt2,gpt2-medium,gpt2-large,gpt2-xl
+#        python bench_load.py --models "" --checkpoint log/model_19072.pt
+
+def run(mode, name, queue):
+    import torch
+    from gpttrainer import GPT, convert_pretrained
+    from checkpoint import load_checkpoint
+    from bench_dataloader import read_status
+    base = read_status("VmHWM")
+    t0 = time.time()
+    if mode == "convert":
+        convert_pretrained(name)
+    elif mode == "hf":
+        model = GPT.from_pretrained(name, fast=False)
+    elif mode == "fast":
+        model = GPT.from_pretrained(name)
+    elif mode == "checkpoint":
+        checkpoint = load_checkpoint(name)
+        model = GPT(checkpoint['config'])
+        model.load_state_dict(checkpoint['model'])
+    elif mode == "from_checkpoint":
+        model = GPT.from_checkpoint(name)
+    load = time.time() - t0
+    if mode != "convert":
+        # touch every weight once so the lazy path pays for its page faults too
+        with torch.no_grad():
+            model(torch.zeros((1, 8), dtype=torch.long))
+    queue.put(dict(load_s=load, first_forward_s=time.time() - t0, peak_mb=(read_status("VmHWM") - base)/1024))
+
+def measure(ctx, mode, name):
+    queue = ctx.Queue()
+    p = ctx.Process(target=run, args=(mode, name, queue))
+    p.start()
+    r = queue.get()
+    p.join()
+    return r
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, default="gpt2,gpt2-medium,gpt2-large,gpt2-xl", help="gpt2 variants or local HF GPT-2 directories")
+    parser.add_argument("--checkpoint", type=str, default="", help="also compare loading this trainer checkpoint")
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    runs = [(name, ["convert", "hf", "fast"]) for name in args.models.split(",") if name]
+    if args.checkpoint:
+        runs.append((args.checkpoint, ["checkpoint", "from_checkpoint"]))
+    for name, modes in runs:
+        for mode in modes:
+            r = measure(ctx, mode, name)
+            print(f"{name:>12s} | {mode:>15s} | load {r['load_s']:7.2f} s | load + first forward {r['first_forward_s']:7.2f} s | peak rss {r['peak_mb']:8.0f} MB")
@@ -0,0 +1,76 @@
+import os
+import time
+import multiprocessing as mp
+
+# full logits + cross entropy against GPT.forward's chunked loss (loss_chunk) on CPU: peak rss and
+# time of a training micro step, peak rss of an eval forward, and how far loss and grads drift
+# each setting runs in its own process so the peak rss of one doesn't hide the next
+# usage: python bench_loss.py --n_layer 4 --n_embd 256 --B 8 --T 512 --chunks 0,2048,512,128
+
+def run_setting(model_kwargs, B, T, loss_chunk, steps, queue):
+    import torch
+    from gpttrainer import GPT, ModelConfig
+    from bench_dataloader import read_status
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(**model_kwargs))
+    x = torch.randint(0, model.config.vocab_size, (B, T))
+    y = torch.randint(0, model.config.vocab_size, (B, T))
+    base = read_status("VmHWM") # weights and runtime, not part of the step
+    with torch.no_grad():
+        model(x, y, loss_chunk=loss_chunk)
+    eval_mb = (read_status("VmHWM") - base)/1024
+    for i in range(steps + 1):
+        if i == 1:
+            t0 = time.time() # the first step allocates the grads
+        _, loss = model(x, y, loss_chunk=loss_chunk)
+        loss.backward()
+    dt = (time.time() - t0) / steps
+    queue.put(dict(train_mb=(read_status("VmHWM") - base)/1024, eval_mb=eval_mb, step_s=dt))
+
+def max_grad_diff(model_kwargs, B, T, loss_chunk):
+    import torch
+    from gpttrainer import GPT, ModelConfig
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(**model_kwargs))
+    x = torch.randint(0, model.config.vocab_size, (B, T))
+    y = torch.randint(0, model.config.vocab_size, (B, T))
+    results = []
+    for chunk in (0, loss_chunk):
+        model.zero_grad()
+        _, loss = model(x, y, loss_chunk=chunk)
+        loss.backward()
+        results.append((loss.item(), [p.grad.clone() for p in model.parameters()]))
+    (loss_a, grads_a), (loss_b, grads_b) = results
+    return abs(loss_a - loss_b), max((a - b).abs().max().item() for a, b in zip(grads_a, grads_b))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--n_embd", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--B", type=int, default=8)
+    parser.add_argument("--T", type=int, default=512)
+    parser.add_argument("--chunks", type=str, default="0,2048,512,128", help="loss_chunk values, 0 is the full logits path")
+    parser.add_argument("--steps", type=int, default=3)
+    args = parser.parse_args()
+    model_kwargs = dict(block_size=args.T, vocab_size=args.vocab_size, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, mask_buffer=False)
+    logits_mb = args.B * args.T * args.vocab_size * 4 / 2**20
+    print(f"B {args.B} x T {args.T} x vocab {args.vocab_size}: full fp32 logits are {logits_mb:.0f} MB")
+
+    # glibc's dynamic mmap threshold moves the repeated chunk-sized buffers onto the brk heap, where
+    # fragmentation inflates rss well past what is live, a fixed threshold keeps the comparison about the tensors
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", str(2**20))
+    ctx = mp.get_context("spawn")
+    for loss_chunk in [int(c) for c in args.chunks.split(",")]:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_setting, args=(model_kwargs, args.B, args.T, loss_chunk, args.steps, queue))
+        p.start()
+        r = queue.get()
+        p.join()
+        line = f"loss_chunk {loss_chunk:5d} | train step peak rss {r['train_mb']:7.0f} MB, {1000*r['step_s']:7.0f} ms | eval forward peak rss {r['eval_mb']:7.0f} MB"
+        if loss_chunk:
+            loss_diff, grad_diff = max_grad_diff(model_kwargs, args.B, args.T, loss_chunk)
+            line += f" | vs full: loss diff {loss_diff:.1e}, max grad diff {grad_diff:.1e}"
+        print(line)
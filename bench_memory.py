@@ -0,0 +1,59 @@
+import time
+import multiprocessing as mp
+
+# peak memory and throughput of a training micro step per (micro batch, activation checkpointing)
+# setting against the analytic estimate in autotune.py, and the plan picked for a memory budget
+# each setting runs in its own process so the peak rss of one doesn't hide the next
+# usage: python bench_memory.py --n_layer 6 --n_embd 384 --T 256 --Bs 1,2,4,8 --budget_gb 2
+
+def run_setting(model_kwargs, B, T, every, steps, queue):
+    import torch
+    from gpttrainer import GPT, ModelConfig
+    from bench_dataloader import read_status
+    base = read_status("VmHWM") # interpreter and torch runtime, not part of the estimate
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(**model_kwargs))
+    model.set_activation_checkpointing(every)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4, fused=False)
+    x = torch.randint(0, model.config.vocab_size, (B, T))
+    for i in range(steps + 1):
+        if i == 1:
+            t0 = time.time() # the first step allocates the optimizer state
+        _, loss = model(x, x)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    dt = (time.time() - t0) / steps
+    queue.put(dict(hwm_mb=(read_status("VmHWM") - base)/1024, tokens_per_sec=B*T/dt))
+
+if __name__ == "__main__":
+    import argparse
+    from gpttrainer import ModelConfig
+    from autotune import checkpoint_policies, estimate_step_memory, plan_micro_batch
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layer", type=int, default=6)
+    parser.add_argument("--n_head", type=int, default=6)
+    parser.add_argument("--n_embd", type=int, default=384)
+    parser.add_argument("--vocab_size", type=int, default=50304)
+    parser.add_argument("--T", type=int, default=256)
+    parser.add_argument("--Bs", type=str, default="1,2,4,8")
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--budget_gb", type=float, default=2.0)
+    args = parser.parse_args()
+    model_kwargs = dict(block_size=args.T, vocab_size=args.vocab_size, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, mask_buffer=False)
+    config = ModelConfig(**model_kwargs)
+
+    ctx = mp.get_context("spawn")
+    for B in [int(b) for b in args.Bs.split(",")]:
+        for every in checkpoint_policies(args.n_layer):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_setting, args=(model_kwargs, B, args.T, every, args.steps, queue))
+            p.start()
+            r = queue.get()
+            p.join()
+            estimate = estimate_step_memory(config, B, args.T, every) / 2**20
+            print(f"B {B:3d} | checkpoint every {every} | peak rss over baseline {r['hwm_mb']:7.0f} MB | estimate {estimate:7.0f} MB | {r['tokens_per_sec']:8.0f} tokens/sec")
+
+    total_batch_size = max(int(b) for b in args.Bs.split(",")) * args.T
+    B, every, grad_accum = plan_micro_batch(config, args.T, total_batch_size, 1, args.budget_gb * 2**30)
+    print(f"budget {args.budget_gb} GB, {total_batch_size} tokens per step: micro batch {B}, checkpoint every {every}, grad_accum_steps {grad_accum}")
@@ -0,0 +1,52 @@
+import time
+import torch
+from gpttrainer import GPT, ModelConfig, document_positions, build_document_mask
+
+# forward/backward cost of packed sequences with document masking against plain causal attention
+# usage: python bench_packed.py --B 8 --T 512 --doc_len 100
+
+def synthetic_batch(B, T, doc_len, eot=50256, vocab_size=50257, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randint(0, vocab_size - 1, (B, T + 1), generator=g)
+    # documents of roughly doc_len tokens, each starting with eot
+    x[torch.rand(B, T + 1, generator=g) < 1.0 / doc_len] = eot
+    return x[:, :-1].contiguous(), x[:, 1:].contiguous()
+
+def time_steps(model, x, y, packing, steps):
+    for i in range(steps + 1):
+        if i == 1:
+            t0 = time.time() # skip the first step as warmup
+        logits, loss = model(x, y, **packing)
+        loss.backward()
+    return (time.time() - t0) / steps
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--B", type=int, default=8)
+    parser.add_argument("--T", type=int, default=512)
+    parser.add_argument("--doc_len", type=int, default=100, help="average document length in tokens")
+    parser.add_argument("--n_layer", type=int, default=4)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--n_embd", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = GPT(ModelConfig(block_size=args.T, vocab_size=50304, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd)).to(args.device)
+    x, y = synthetic_batch(args.B, args.T, args.doc_len)
+    t0 = time.time()
+    doc_ids, pos = document_positions(x)
+    t_pack = time.time() - t0
+    x, y, doc_ids, pos = x.to(args.device), y.to(args.device), doc_ids.to(args.device), pos.to(args.device)
+    t0 = time.time()
+    build_document_mask(doc_ids)
+    t_mask = time.time() - t0
+
+    t_causal = time_steps(model, x, y, {}, args.steps)
+    t_docs = time_steps(model, x, y, {"doc_ids": doc_ids, "pos": pos}, args.steps)
+    tokens = args.B * args.T
+    print(f"{int(doc_ids[:, -1].sum())} documents in {args.B}x{args.T} | packing {t_pack*1000:.2f} ms | mask build {t_mask*1000:.2f} ms")
+    print(f"causal     | {t_causal*1000:8.1f} ms/step | {tokens/t_causal:10.0f} tok/s")
+    print(f"doc masked | {t_docs*1000:8.1f} ms/step | {tokens/t_docs:10.0f} tok/s | overhead {100*(t_docs/t_causal-1):+.1f}%")
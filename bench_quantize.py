@@ -0,0 +1,94 @@
+import copy
+import time
+import torch
+import torch.nn.functional as F
+from gpttrainer import GPT, ModelConfig
+from quantize import quantize_model, model_bytes
+
+# float vs weight-only int8 GPT on CPU: memory, perplexity, HellaSwag accuracy, forward and decode latency
+# usage: python bench_quantize.py --model gpt2 --text input.txt --hella_examples 500
+#        python bench_quantize.py --checkpoint log --data_root edu_fineweb10B
+
+def load(args):
+    if args.model:
+        return GPT.from_pretrained(args.model)
+    if args.checkpoint:
+        from serve import load_model
+        return load_model(args.checkpoint)
+    torch.manual_seed(0)
+    return GPT(ModelConfig(block_size=1024, vocab_size=50257, n_layer=args.n_layer, n_head=args.n_embd // 64, n_embd=args.n_embd, mask_buffer=False))
+
+def eval_windows(args, T):
+    # (N, T+1) token windows from the val shards, or from a text file
+    if args.data_root:
+        from gpttrainer import ValidationSet
+        val = ValidationSet(T, args.ppl_tokens, 0, 1, data_root=args.data_root)
+        return torch.cat([val.x, val.y[:, -1:]], dim=1)
+    import tiktoken
+    with open(args.text) as f:
+        tokens = torch.tensor(tiktoken.get_encoding("gpt2").encode(f.read()), dtype=torch.long)
+    n = min(len(tokens) - 1, args.ppl_tokens) // T
+    return torch.stack([tokens[i*T:i*T+T+1] for i in range(n)])
+
+@torch.no_grad()
+def perplexity(model, windows, B=8):
+    loss_sum, count = 0.0, 0
+    for i in range(0, len(windows), B):
+        x, y = windows[i:i+B, :-1], windows[i:i+B, 1:]
+        logits, _ = model(x)
+        loss_sum += F.cross_entropy(logits.view(-1, logits.size(-1)), y.reshape(-1), reduction='sum').item()
+        count += y.numel()
+    return torch.exp(torch.tensor(loss_sum / count)).item()
+
+@torch.no_grad()
+def latency(model, B, T, new_tokens, repeats=3):
+    x = torch.randint(0, model.config.vocab_size, (B, T))
+    model(x)
+    t0 = time.time()
+    for _ in range(repeats):
+        model(x)
+    forward_ms = 1000 * (time.time() - t0) / repeats
+    prompt = x[:1, :8]
+    model.generate(prompt, 2, temperature=0.0)
+    t0 = time.time()
+    model.generate(prompt, new_tokens, temperature=0.0)
+    decode_ms = 1000 * (time.time() - t0) / new_tokens
+    return forward_ms, decode_ms
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="", help="gpt2 variant for from_pretrained")
+    parser.add_argument("--checkpoint", type=str, default="", help="trainer checkpoint or log_dir")
+    parser.add_argument("--n_layer", type=int, default=12, help="random init model when neither is given")
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--data_root", type=str, default="", help="val shards for perplexity, otherwise --text")
+    parser.add_argument("--text", type=str, default="input.txt")
+    parser.add_argument("--ppl_tokens", type=int, default=32768)
+    parser.add_argument("--T", type=int, default=256)
+    parser.add_argument("--hella_examples", type=int, default=0, help="HellaSwag val examples to score, 0 skips")
+    parser.add_argument("--new_tokens", type=int, default=32)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+
+    models = {"float": load(args).eval()}
+    models["int8"] = quantize_model(copy.deepcopy(models["float"]))
+    windows = eval_windows(args, args.T)
+    hella = None
+    if args.hella_examples > 0:
+        from hellaswag import CachedExamples, evaluate_batched
+        examples = CachedExamples("val")
+        hella = [examples[i] for i in range(min(args.hella_examples, len(examples)))]
+
+    x = windows[:4, :-1]
+    agree = (models["float"](x)[0].argmax(-1) == models["int8"](x)[0].argmax(-1)).float().mean().item()
+    print(f"top-1 next token agreement int8 vs float: {100*agree:.2f}%")
+    base = model_bytes(models["float"])
+    for name, model in models.items():
+        line = f"{name:>5s} | {model_bytes(model)/2**20:7.1f} MB ({base/model_bytes(model):.2f}x smaller) | ppl {perplexity(model, windows):9.3f}"
+        if hella is not None:
+            result = evaluate_batched(lambda tokens: model(tokens)[0], hella, "cpu")
+            line += f" | hellaswag acc_norm {result['num_correct_norm']/result['num_total']:.4f}"
+        forward_ms, decode_ms = latency(model, 4, args.T, args.new_tokens)
+        line += f" | forward 4x{args.T} {forward_ms:7.1f} ms | decode {decode_ms:6.1f} ms/token"
+        print(line)
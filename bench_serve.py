@@ -0,0 +1,84 @@
+import json
+import time
+import random
+import threading
+import urllib.request
+import numpy as np
+import torch
+from gpttrainer import GPT, ModelConfig
+from serve import Engine, load_model
+
+# load generator for serve.py: poisson arrivals of requests with random prompt and output lengths,
+# against an in-process engine per max_batch setting or a running http server,
+# reporting throughput and p50/p99 latency and time to first token
+# usage: python bench_serve.py --max_batches 1,8,32 --num_requests 64 --rate 8
+#        python bench_serve.py --url http://127.0.0.1:8000 --num_requests 64 --rate 8
+
+def make_requests(num_requests, prompt_len, max_tokens, vocab_size, seed=0):
+    rng = random.Random(seed)
+    return [dict(tokens=[rng.randrange(vocab_size) for _ in range(rng.randint(1, prompt_len))],
+                 max_tokens=rng.randint(1, max_tokens), temperature=1.0, top_k=50) for _ in range(num_requests)]
+
+def run_load(send, requests, rate, seed=0):
+    # send(body) blocks until the completion and returns (ttft, latency), one thread per request
+    rng = random.Random(seed)
+    results = [None] * len(requests)
+    def worker(i, body):
+        results[i] = send(body)
+    threads = []
+    t0 = time.time()
+    for i, body in enumerate(requests):
+        if rate > 0:
+            time.sleep(rng.expovariate(rate))
+        threads.append(threading.Thread(target=worker, args=(i, body)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - t0
+
+def report(name, requests, results, dt):
+    ttft = np.array([r[0] for r in results])
+    latency = np.array([r[1] for r in results])
+    tokens = sum(body["max_tokens"] for body in requests)
+    print(f"{name} | {tokens/dt:8.1f} tok/s | {len(requests)/dt:6.2f} req/s | latency p50 {1000*np.percentile(latency, 50):8.1f} ms"
+          f" p99 {1000*np.percentile(latency, 99):8.1f} ms | ttft p50 {1000*np.percentile(ttft, 50):7.1f} ms p99 {1000*np.percentile(ttft, 99):7.1f} ms")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default="", help="served model, empty for a random init model of --n_layer/--n_embd")
+    parser.add_argument("--n_layer", type=int, default=6)
+    parser.add_argument("--n_embd", type=int, default=384)
+    parser.add_argument("--url", type=str, default="", help="benchmark a running serve.py instead of in-process engines")
+    parser.add_argument("--max_batches", type=str, default="1,8,32")
+    parser.add_argument("--num_requests", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=8.0, help="mean requests per second, 0 sends all at once")
+    parser.add_argument("--prompt_len", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    requests = make_requests(args.num_requests, args.prompt_len, args.max_tokens, 50257)
+    if args.url:
+        def send(body):
+            t = time.time()
+            data = json.loads(urllib.request.urlopen(urllib.request.Request(args.url, data=json.dumps(body).encode())).read())
+            return data["ttft"], time.time() - t
+        results, dt = run_load(send, requests, args.rate)
+        report(args.url, requests, results, dt)
+        exit(0)
+
+    if args.checkpoint:
+        model = load_model(args.checkpoint)
+    else:
+        torch.manual_seed(0)
+        model = GPT(ModelConfig(block_size=args.prompt_len + args.max_tokens, vocab_size=50257, n_layer=args.n_layer,
+                                n_head=args.n_embd // 64, n_embd=args.n_embd, mask_buffer=False)).eval()
+    for max_batch in [int(b) for b in args.max_batches.split(",")]:
+        engine = Engine(model, max_batch=max_batch).start()
+        def send(body):
+            request = engine.submit(**body)
+            request.done.wait()
+            return request.first_token_time - request.arrival_time, request.finish_time - request.arrival_time
+        results, dt = run_load(send, requests, args.rate)
+        engine.close()
+        report(f"max_batch {max_batch:3d} (mean {engine.num_rows/max(1, engine.num_steps):5.1f})", requests, results, dt)
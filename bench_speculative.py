@@ -0,0 +1,54 @@
+import time
+import torch
+from gpttrainer import GPT, ModelConfig
+
+# speculative decoding with a draft GPT against plain kv cache generation of the target on CPU,
+# reporting tokens per target forward and the wall-clock speedup for each draft length k
+# usage: python bench_speculative.py --target gpt2-medium --draft gpt2 --ks 2,4,6
+#        python bench_speculative.py (random init models, acceptance is only meaningful with real weights)
+
+def load_model(name, n_layer, n_head, n_embd, block_size):
+    if name.startswith("gpt2"):
+        return GPT.from_pretrained(name)
+    torch.manual_seed(0)
+    return GPT(ModelConfig(block_size=block_size, vocab_size=50257, n_layer=n_layer, n_head=n_head, n_embd=n_embd, mask_buffer=False))
+
+def timed(fn, seed=42):
+    rng = torch.Generator(device="cpu")
+    rng.manual_seed(seed)
+    t0 = time.time()
+    out = fn(rng)
+    return out, time.time() - t0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, default="random", help="gpt2 variant name, or random for --target_layers/--target_embd")
+    parser.add_argument("--draft", type=str, default="random", help="gpt2 variant name, or random for --draft_layers/--draft_embd")
+    parser.add_argument("--target_layers", type=int, default=12)
+    parser.add_argument("--target_embd", type=int, default=768)
+    parser.add_argument("--draft_layers", type=int, default=2)
+    parser.add_argument("--draft_embd", type=int, default=256)
+    parser.add_argument("--prompt", type=str, default="Hello, I'm a language model,")
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--ks", type=str, default="2,4,6")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=None)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+
+    import tiktoken
+    enc = tiktoken.get_encoding("gpt2")
+    prompt = torch.tensor([enc.encode(args.prompt)], dtype=torch.long)
+    block_size = prompt.size(1) + args.new_tokens
+    target = load_model(args.target, args.target_layers, args.target_embd // 64, args.target_embd, block_size).eval()
+    draft = load_model(args.draft, args.draft_layers, args.draft_embd // 64, args.draft_embd, block_size).eval()
+    sampling = dict(temperature=args.temperature, top_k=args.top_k)
+
+    timed(lambda rng: target.generate(prompt, 4, generator=rng, **sampling)) # warmup
+    _, t_base = timed(lambda rng: target.generate(prompt, args.new_tokens, generator=rng, **sampling))
+    print(f"target only | {args.new_tokens/t_base:7.1f} tok/s")
+    for k in [int(k) for k in args.ks.split(",")]:
+        (out, stats), t = timed(lambda rng: target.generate_speculative(draft, prompt, args.new_tokens, k=k, generator=rng, **sampling))
+        print(f"k {k:2d} | accepted {stats['accepted']}/{stats['drafted']} drafts | {args.new_tokens/stats['target_forwards']:5.2f} tokens per target forward"
+              f" | {args.new_tokens/t:7.1f} tok/s | speedup {t_base/t:5.2f}x")
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import contextlib
+import statistics
+import multiprocessing as mp
+import numpy as np
+
+# reproducible CPU performance suite: fixed-config training of small ModelConfig variants through the
+# real Trainer (GPT, DataLoaderLite, PrefetchLoader, AdamW) on synthetic or input.txt shards, plus data
+# loading, HellaSwag scoring and sampling timed on their own. Every metric is timed for at least
+# --min_seconds and the suite runs --repeats times, results are the per metric medians along with their
+# run to run noise (MAD based). A gating metric worse than the baseline by more than --threshold is a
+# regression (exit code 1), metrics whose noise is too large for that threshold are reported as not gating
+# usage: python bench_suite.py --save bench_baseline.json
+#        python bench_suite.py --baseline bench_baseline.json --threshold 0.15
+#        python bench_suite.py --text input.txt --only train_tiny,sample --out results.json
+
+VARIANTS = {
+    # name: ModelConfig / TrainConfig fields
+    "train_tiny": dict(n_layer=2, n_head=2, n_embd=128, B=8, T=128),
+    "train_small": dict(n_layer=4, n_head=4, n_embd=256, B=8, T=256),
+}
+
+def write_text_shards(root, text_path, shard_size=1000000):
+    # input.txt tokenized and laid out like the fineweb.py output, the first 10% is the val shard
+    import tiktoken
+    with open(text_path) as f:
+        tokens = np.array(tiktoken.get_encoding("gpt2").encode_ordinary(f.read()), dtype=np.uint16)
+    n_val = len(tokens) // 10
+    os.makedirs(root, exist_ok=True)
+    np.save(os.path.join(root, "edufineweb_val_000000"), tokens[:n_val])
+    for i, start in enumerate(range(n_val, len(tokens), shard_size)):
+        np.save(os.path.join(root, f"edufineweb_train_{i+1:06d}"), tokens[start:start+shard_size])
+    return root
+
+def timed(fn, min_seconds):
+    # calls fn until at least min_seconds have passed, returns (calls, seconds), so short
+    # metrics aren't dominated by timer and scheduler noise
+    calls, t0 = 0, time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        dt = time.perf_counter() - t0
+        if dt >= min_seconds:
+            return calls, dt
+
+def bench_train(data_root, fields, device, min_seconds, warmup=2, queue=None):
+    import torch
+    from gpttrainer import Trainer, TrainConfig
+    with tempfile.TemporaryDirectory() as log_dir, contextlib.redirect_stdout(open(os.devnull, "w")):
+        config = TrainConfig(data_root=data_root, log_dir=log_dir, device=device, dtype="float32", seed=1337,
+                             vocab_size=50304, block_size=fields["T"], total_batch_size=fields["B"]*fields["T"],
+                             max_steps=10**6, warmup_steps=1, val_tokens=fields["T"]*8,
+                             val_interval=0, hella_interval=0, sample_interval=0, checkpoint_interval=0, metrics_file="", **fields)
+        trainer = Trainer(config)
+        step = 0
+        def train_step():
+            nonlocal step
+            trainer.profiler.begin_step(step)
+            trainer.train_step(step)
+            step += 1
+        for _ in range(warmup):
+            train_step()
+        steps, dt = timed(train_step, min_seconds)
+        trainer.close()
+    result = {"tokens_per_sec": steps * fields["B"] * fields["T"] / dt, "step_ms": 1000 * dt / steps}
+    if queue is not None:
+        queue.put(result)
+    return result
+
+def bench_dataloader(data_root, min_seconds, B=16, T=1024):
+    from gpttrainer import DataLoaderLite
+    loader = DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=data_root)
+    for _ in range(100):
+        loader.next_batch()
+    batches, dt = timed(loader.next_batch, min_seconds)
+    return {"batches_per_sec": batches / dt}
+
+def small_model():
+    import torch
+    from gpttrainer import GPT, ModelConfig
+    torch.manual_seed(0)
+    return GPT(ModelConfig(block_size=256, vocab_size=50304, n_layer=4, n_head=4, n_embd=256, mask_buffer=False)).eval()
+
+def bench_hellaswag(min_seconds, num_examples=16):
+    from hellaswag import evaluate_batched
+    from bench_hellaswag import synthetic_datas
+    model = small_model()
+    datas = synthetic_datas(num_examples, 50257)
+    evaluate = lambda: evaluate_batched(lambda tokens: model(tokens)[0], datas, "cpu")
+    evaluate() # warmup
+    passes, dt = timed(evaluate, min_seconds)
+    return {"examples_per_sec": passes * num_examples / dt}
+
+def bench_sample(min_seconds, new_tokens=32, B=4):
+    import torch
+    model = small_model()
+    generator = torch.Generator().manual_seed(42)
+    prompt = torch.randint(0, 50257, (B, 16), generator=generator)
+    with torch.no_grad():
+        model.generate(prompt, 4, generator=generator) # warmup
+        calls, dt = timed(lambda: model.generate(prompt, new_tokens, top_k=50, generator=generator), min_seconds)
+    return {"tokens_per_sec": calls * B * new_tokens / dt}
+
+# metric -> True when higher is better, metrics not listed here are informational and never compared
+HIGHER_IS_BETTER = {"tokens_per_sec": True, "batches_per_sec": True, "examples_per_sec": True}
+
+def run_suite(args):
+    import torch
+    torch.set_num_threads(args.threads)
+    results = {}
+    only = set(args.only.split(",")) if args.only else None
+    with tempfile.TemporaryDirectory() as root:
+        if args.text:
+            write_text_shards(root, args.text)
+        else:
+            from bench_dataloader import write_synthetic_shards
+            write_synthetic_shards(root, 3, 2000000)
+        ctx = mp.get_context("spawn")
+        for name, fields in VARIANTS.items():
+            if only is None or name in only:
+                # each training run in its own process, so allocator and thread pool state don't carry over
+                queue = ctx.Queue()
+                p = ctx.Process(target=bench_train, args=(root, fields, args.device, args.min_seconds), kwargs=dict(queue=queue))
+                p.start()
+                results[name] = queue.get()
+                p.join()
+                print(f"{name}: {results[name]}", file=sys.stderr)
+        for name, fn in [("dataloader", lambda: bench_dataloader(root, args.min_seconds)),
+                         ("hellaswag", lambda: bench_hellaswag(args.min_seconds)),
+                         ("sample", lambda: bench_sample(args.min_seconds))]:
+            if only is None or name in only:
+                results[name] = fn()
+                print(f"{name}: {results[name]}", file=sys.stderr)
+    return results
+
+def summarize(runs):
+    """
+    Per metric median over the repeated runs, and its noise: the median absolute deviation scaled
+    to a standard deviation (1.4826 * MAD) relative to the median, which a single slow or fast
+    run doesn't move the way it moves the range
+    """
+    medians, noise = {}, {}
+    for name in runs[0]:
+        medians[name], noise[name] = {}, {}
+        for metric in runs[0][name]:
+            values = [run[name][metric] for run in runs]
+            median = statistics.median(values)
+            medians[name][metric] = median
+            noise[name][metric] = 1.4826 * statistics.median(abs(v - median) for v in values) / median
+    return medians, noise
+
+def compare(results, noise, baseline, threshold):
+    """
+    Returns (lines, regressions, noisy): one line per compared metric with its change against the
+    baseline, the gating metrics that got worse by more than threshold, and the metrics that don't
+    gate because the noise recorded with the baseline is over threshold / 2 (the difference of two
+    medians of a few runs is roughly as noisy as one run, so 2 sigma has to fit in threshold).
+    Gating only depends on the baseline, so a noisy run can't switch a metric's gate off
+    """
+    lines, regressions, noisy = [], [], []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric not in HIGHER_IS_BETTER or name not in baseline["results"] or metric not in baseline["results"][name]:
+                continue
+            base = baseline["results"][name][metric]
+            sigma = baseline.get("noise", {}).get(name, {}).get(metric, 0.0)
+            change = value / base - 1 if HIGHER_IS_BETTER[metric] else base / value - 1 # > 0 is an improvement
+            if 2 * sigma > threshold:
+                status = "not gating, too noisy"
+                noisy.append(f"{name}.{metric}")
+            elif change < -threshold:
+                status = "REGRESSION"
+                regressions.append(f"{name}.{metric}")
+            else:
+                status = "ok"
+            lines.append(f"{name + '.' + metric:>32s} | {value:12.2f} | baseline {base:12.2f} | {100*change:+6.1f}% | noise {100*sigma:4.1f}% baseline, {100*noise[name][metric]:4.1f}% now | {status}")
+    return lines, regressions, noisy
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", type=str, default="", help="build the shards from this text file instead of random tokens")
+    parser.add_argument("--only", type=str, default="", help="comma separated subset of " + ",".join(list(VARIANTS) + ["dataloader", "hellaswag", "sample"]))
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads, fixed so results don't depend on the core count")
+    parser.add_argument("--min_seconds", type=float, default=2.0, help="minimum timed duration of every metric")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of the suite, each metric keeps its median")
+    parser.add_argument("--out", type=str, default="", help="write the results json here")
+    parser.add_argument("--save", type=str, default="", help="write the results as the new baseline")
+    parser.add_argument("--baseline", type=str, default="", help="compare against this baseline json")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown as a fraction before a gating metric counts as a regression")
+    args = parser.parse_args()
+
+    import torch
+    runs = [run_suite(args) for _ in range(args.repeats)]
+    results, noise = summarize(runs)
+    report = {
+        "meta": {"torch": torch.__version__, "numpy": np.__version__, "python": platform.python_version(),
+                 "machine": platform.machine(), "cpu_count": os.cpu_count(), "threads": args.threads,
+                 "min_seconds": args.min_seconds, "repeats": args.repeats,
+                 "text": os.path.basename(args.text) if args.text else "synthetic", "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+        "noise": noise,
+        "runs": runs,
+    }
+    for path in [args.out, args.save]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("text") != report["meta"]["text"] or baseline["meta"].get("threads") != args.threads:
+            print("warning: the baseline was recorded with different data or threads", file=sys.stderr)
+        lines, regressions, noisy = compare(results, noise, baseline, args.threshold)
+        print("\n".join(lines))
+        if noisy:
+            print(f"not gating, noise over {100*args.threshold/2:.1f}%: {', '.join(noisy)}")
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {100*args.threshold:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"no regressions beyond {100*args.threshold:.0f}% in the gating metrics")
@@ -0,0 +1,33 @@
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+from fineweb import iterate_documents, iterate_tokenized
+
+# tokens/sec of the per-document and the batched shared memory tokenizers in fineweb.py
+# usage: python bench_tokenize.py --input input.txt --repeat 20 --procs 1,2,4
+
+def run(docs, nprocs, batch_size):
+    with mp.Pool(nprocs) as pool:
+        t0 = time.time()
+        num_tokens = 0
+        for tokens in iterate_tokenized(pool, docs, np.uint16, batch_size):
+            num_tokens += len(tokens)
+        return num_tokens, time.time() - t0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=os.path.join(os.path.dirname(__file__), "input.txt"))
+    parser.add_argument("--repeat", type=int, default=10, help="repeat the corpus to make the run longer")
+    parser.add_argument("--procs", type=str, default=f"1,2,4,{os.cpu_count()}")
+    parser.add_argument("--batch_size", type=int, default=256)
+    args = parser.parse_args()
+
+    docs = list(iterate_documents(args.input)) * args.repeat
+    print(f"{len(docs)} documents")
+    for nprocs in sorted(set(int(p) for p in args.procs.split(","))):
+        n_doc, t_doc = run(docs, nprocs, 0)
+        n_batch, t_batch = run(docs, nprocs, args.batch_size)
+        assert n_doc == n_batch
+        print(f"procs {nprocs:3d} | per-document {n_doc/t_doc:12,.0f} tok/s | batched {n_batch/t_batch:12,.0f} tok/s | speedup {t_doc/t_batch:5.2f}x")
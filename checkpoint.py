@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import types
+import pickle
+import glob
+import time
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+# -----------------------------------------------------------------------------
+# full training state checkpoints: model, optimizer, step, rng and data loader cursors
+# saved either as one model_<step>.pt written by rank 0, or sharded as a model_<step>/
+# directory with one rank<r>.pt per rank, which loads back into the same dict at any world size
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+def save_checkpoint(checkpoint, path):
+    """Writes the checkpoint to a temp file next to path and renames it into place,
+    so a job killed mid-write never leaves a truncated checkpoint behind"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def snapshot(obj, memo=None):
+    """Deep copy of a (nested) state with every tensor copied to cpu, so training can keep
+    updating the live tensors while the copy is written out. Aliases (the tied wte/lm_head
+    weights) are copied once and stay shared, so they are saved as one storage"""
+    memo = {} if memo is None else memo
+    if torch.is_tensor(obj):
+        key = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+        if key not in memo:
+            memo[key] = obj.detach().to("cpu", copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: snapshot(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+def optimizer_shard(optimizer, rank, world_size):
+    """
+    The part of the optimizer state this rank writes in a sharded checkpoint, keyed by the
+    global parameter index of optimizer.state_dict(). With ZeroRedundancyOptimizer a rank
+    writes the partition it owns, otherwise the state is split round-robin over the ranks.
+    """
+    local = getattr(optimizer, "optim", optimizer) # ZeroRedundancyOptimizer keeps its partition in .optim
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    state = {}
+    for i, p in enumerate(params):
+        if p in local.state and (local is not optimizer or i % world_size == rank):
+            state[i] = local.state[p]
+    groups, start = [], 0
+    for group in optimizer.param_groups:
+        groups.append({**{k: v for k, v in group.items() if k != 'params'}, 'params': list(range(start, start + len(group['params'])))})
+        start += len(group['params'])
+    return {'state': state, 'param_groups': groups}
+
+def shard_filename(path, rank):
+    return os.path.join(path, f"rank{rank:05d}.pt")
+
+def write_world_size(path, world_size):
+    # rank 0 records the world size of a sharded checkpoint next to the shards
+    os.makedirs(path, exist_ok=True)
+    marker = os.path.join(path, "world_size")
+    with open(marker + ".tmp", "w") as f:
+        f.write(str(world_size))
+    os.replace(marker + ".tmp", marker)
+
+def is_complete(path):
+    # a sharded checkpoint is usable once every rank has renamed its file into place
+    if not os.path.isdir(path):
+        return os.path.isfile(path)
+    shards = glob.glob(os.path.join(path, "rank*.pt"))
+    if not shards:
+        return False
+    marker = os.path.join(path, "world_size")
+    if os.path.isfile(marker):
+        with open(marker) as f:
+            world_size = int(f.read())
+    else:
+        # written before the marker existed, mmap reads the pickle but none of the tensor data
+        world_size = _load(shards[0], "cpu", mmap=True)['world_size']
+    return len(shards) == world_size
+
+class _Unpickler(pickle.Unpickler):
+    # `python gpttrainer.py` pickles its classes as __main__.ModelConfig, resolve them from
+    # the gpttrainer module when loading from any other entry point
+    def find_class(self, module, name):
+        if module == "__main__" and not hasattr(sys.modules["__main__"], name):
+            module = "gpttrainer"
+        return super().find_class(module, name)
+
+_pickle_module = types.SimpleNamespace(__name__="pickle", Unpickler=_Unpickler, load=pickle.load)
+
+def _load(path, map_location, mmap=False):
+    # checkpoints hold the ModelConfig dataclass and rng tuples, so they are not weights_only
+    return torch.load(path, map_location=map_location, weights_only=False, pickle_module=_pickle_module, mmap=mmap)
+
+def load_checkpoint(path, map_location="cpu", mmap=False):
+    # with mmap the tensors are backed by the file and only read when touched
+    if not os.path.isdir(path):
+        return _load(path, map_location, mmap)
+    # merge the per-rank shards back into the single file layout
+    shards = [_load(f, map_location, mmap) for f in sorted(glob.glob(os.path.join(path, "rank*.pt")))]
+    assert len(shards) == shards[0]['world_size'], f"incomplete sharded checkpoint {path}"
+    checkpoint = dict(shards[0]['meta'])
+    checkpoint['model'] = {k: v for shard in shards for k, v in shard['model'].items()}
+    checkpoint['optimizer'] = {'state': {i: v for shard in shards for i, v in shard['optimizer']['state'].items()},
+                               'param_groups': shards[0]['optimizer']['param_groups']}
+    checkpoint['loader'] = [shard['loader'] for shard in shards]
+    checkpoint['rng'] = [shard['rng'] for shard in shards]
+    return checkpoint
+
+def list_checkpoints(log_dir):
+    # model_<step>.pt files and model_<step>/ directories, oldest first
+    paths = [p for p in glob.glob(os.path.join(log_dir, "model_*")) if re.fullmatch(r"model_\d+(\.pt)?", os.path.basename(p))]
+    return sorted(paths, key=lambda p: int(re.findall(r"\d+", os.path.basename(p))[0]))
+
+def latest_checkpoint(log_dir):
+    """Returns the path of the newest complete checkpoint in log_dir, or None"""
+    paths = [p for p in list_checkpoints(log_dir) if is_complete(p)]
+    return paths[-1] if paths else None
+
+def prune_checkpoints(log_dir, keep):
+    """Deletes everything older than the newest keep complete checkpoints, newer incomplete
+    ones (other ranks still writing) are left alone"""
+    paths = list_checkpoints(log_dir)
+    complete = [p for p in paths if is_complete(p)]
+    if keep <= 0 or len(complete) <= keep:
+        return
+    for p in paths[:paths.index(complete[-keep])]:
+        shutil.rmtree(p) if os.path.isdir(p) else os.remove(p)
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread. save() only snapshots the state to cpu
+    (and waits for the previous write if it is still running, so at most one snapshot is
+    held in memory), the serialization and fsync happen off the step loop.
+    on_done(checkpoint, path, seconds) is called from the writer thread after each write.
+    """
+    def __init__(self, log_dir, keep=0, background=True, prune=True, on_done=None):
+        self.log_dir = log_dir
+        self.keep = keep
+        self.background = background
+        self.prune = prune # only one rank should delete old checkpoints
+        self.on_done = on_done
+        self.queue = queue.Queue(maxsize=1)
+        self.pending = threading.Event()
+        self.pending.set()
+        self.error = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _write(self, checkpoint, path):
+        t0 = time.time()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if checkpoint.get('rank') == 0:
+            write_world_size(os.path.dirname(path), checkpoint['world_size'])
+        save_checkpoint(checkpoint, path)
+        if self.prune:
+            prune_checkpoints(self.log_dir, self.keep)
+        if self.on_done is not None:
+            self.on_done(checkpoint, path, time.time() - t0)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            self.pending.set()
+
+    def save(self, checkpoint, path):
+        """Returns the seconds the caller was blocked for"""
+        t0 = time.time()
+        self.wait()
+        checkpoint = snapshot(checkpoint)
+        if self.background:
+            self.pending.clear()
+            self.queue.put((checkpoint, path))
+        else:
+            self._write(checkpoint, path)
+        return time.time() - t0
+
+    def wait(self):
+        self.pending.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
@@ -1,73 +1,264 @@
 import os
+import json
+import hashlib
+import itertools
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from functools import partial
 import numpy as np
 import tiktoken
-from datasets import load_dataset # pip install datasets
 from tqdm import tqdm # pip install tqdm
 
 # ------------------------------------------
+# streams documents from fineweb-edu (or a local text/jsonl corpus), tokenizes them and
+# writes fixed size token shards. Shards are written atomically and recorded in a manifest,
+# so an interrupted run picks up after the last completed shard. Every shard gets a sidecar
+# index with its document offsets, token count and checksum.
+# python fineweb.py                                               (fineweb-edu sample-10BT)
+# python fineweb.py --input input.txt --out_dir shakespeare --shard_size 100000
 local_dir = "edu_fineweb10B"
 remote_name = "sample-10BT"
 shard_size = int(1e8) # 100M tokens per shard, total of 100 shards
-
-# create the cache the local directory if it doesn't exist yet
-DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), local_dir)
-os.makedirs(DATA_CACHE_DIR, exist_ok=True)
-
-# download the dataset
-fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
+MANIFEST = "manifest.json"
 
 # init the tokenizer
 enc = tiktoken.get_encoding("gpt2")
 eot = enc._special_tokens['<|endoftext|>'] # end of text token
-def tokenize(doc):
-    # tokenizes a single document and returns a numpy array of uint16 tokens
+def tokenize(doc, dtype=np.uint16):
+    # tokenizes a single document and returns a numpy array of tokens
     tokens = [eot] # the special <|endoftext|> token delimits all documents
     tokens.extend(enc.encode_ordinary(doc["text"]))
     tokens_np = np.array(tokens)
-    assert (0 <= tokens_np).all() and (tokens_np < 2**16).all(), "token dictionary too large for uint16"
-    tokens_np_uint16 = tokens_np.astype(np.uint16)
-    return tokens_np_uint16
+    assert (0 <= tokens_np).all() and (tokens_np < np.iinfo(dtype).max + 1).all(), f"token dictionary too large for {np.dtype(dtype).name}"
+    return tokens_np.astype(dtype)
+
+def tokenize_batch(docs, dtype=np.uint16):
+    # tokenizes a batch of documents into one flat buffer, each document prefixed with eot, and
+    # places it in shared memory so only the segment name and the lengths go back through the pipe
+    assert enc.n_vocab <= np.iinfo(dtype).max + 1, f"token dictionary too large for {np.dtype(dtype).name}"
+    token_lists = enc.encode_ordinary_batch([doc["text"] for doc in docs], num_threads=1) # parallelism comes from the pool
+    lengths = np.array([len(tokens) + 1 for tokens in token_lists], dtype=np.int64)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(lengths.sum()) * np.dtype(dtype).itemsize))
+    buf = np.ndarray((int(lengths.sum()),), dtype=dtype, buffer=shm.buf)
+    pos = 0
+    for tokens in token_lists:
+        buf[pos] = eot
+        buf[pos+1:pos+1+len(tokens)] = tokens
+        pos += len(tokens) + 1
+    del buf
+    shm.close()
+    # the parent owns the segment from here on and unlinks it once it has copied it out
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm.name, lengths
+
+def read_shared_batch(name, lengths, dtype):
+    # copies a tokenize_batch result out of shared memory and frees the segment
+    shm = shared_memory.SharedMemory(name=name)
+    tokens = np.ndarray((int(lengths.sum()),), dtype=dtype, buffer=shm.buf).copy()
+    shm.close()
+    shm.unlink()
+    return tokens
+
+def iterate_tokenized(pool, docs, dtype=np.uint16, batch_size=0):
+    """Yields one token array per document, in order. With batch_size > 0 the workers
+    tokenize batch_size documents at a time and return them through shared memory."""
+    if batch_size <= 0:
+        yield from imap_bounded(pool, partial(tokenize, dtype=dtype), docs)
+        return
+    docs = iter(docs)
+    batches = iter(lambda: list(itertools.islice(docs, batch_size)), [])
+    for name, lengths in imap_bounded(pool, partial(tokenize_batch, dtype=dtype), batches, window=64, chunksize=1):
+        tokens = read_shared_batch(name, lengths, dtype)
+        yield from np.split(tokens, np.cumsum(lengths)[:-1])
 
 def write_datafile(filename, tokens_np):
-    np.save(filename, tokens_np)
+    # write under a temp name and rename, so a crash never leaves a truncated shard behind
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        np.save(f, tokens_np)
+    os.replace(tmp_filename, filename)
+
+def index_filename(filename):
+    # sidecar next to each shard: edufineweb_train_000001.npy -> edufineweb_train_000001.idx.npz
+    return filename[:-len(".npy")] + ".idx.npz"
+
+def shard_checksum(tokens_np):
+    return hashlib.sha256(np.ascontiguousarray(tokens_np).data).hexdigest()
+
+def write_index(filename, tokens_np):
+    """
+    Writes the sidecar index of a shard: the offset of every document start (each document
+    begins with eot, a document continued from the previous shard has no start here), the
+    token count and a sha256 of the token bytes. Returns the summary stored in the manifest.
+    """
+    doc_starts = np.flatnonzero(tokens_np == eot).astype(np.int64)
+    checksum = shard_checksum(tokens_np)
+    tmp_filename = index_filename(filename) + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        np.savez(f, doc_starts=doc_starts, num_tokens=np.int64(len(tokens_np)), checksum=np.array(checksum))
+    os.replace(tmp_filename, index_filename(filename))
+    return {"num_tokens": len(tokens_np), "num_docs": len(doc_starts), "checksum": checksum}
+
+def load_index(filename):
+    # returns dict(doc_starts, num_tokens, checksum) for a shard, or None if it has no sidecar
+    path = index_filename(filename)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {"doc_starts": f["doc_starts"], "num_tokens": int(f["num_tokens"]), "checksum": str(f["checksum"])}
+
+def index_shards(out_dir):
+    # backfills sidecars for shards written before indexes existed
+    for filename in sorted(f for f in os.listdir(out_dir) if f.endswith(".npy")):
+        path = os.path.join(out_dir, filename)
+        if not os.path.exists(index_filename(path)):
+            info = write_index(path, np.load(path, mmap_mode='r'))
+            print(f"{filename}: {info['num_tokens']} tokens, {info['num_docs']} documents")
+
+def iterate_documents(input_path=None, remote_name=remote_name):
+    """Lazily yields {"text": ...} documents, from fineweb-edu in streaming mode or from a local file.
+    Local .jsonl files need a "text" field per line, other files are split into documents on blank lines."""
+    if input_path is None:
+        from datasets import load_dataset # pip install datasets
+        yield from load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train", streaming=True)
+    elif input_path.endswith(".jsonl"):
+        with open(input_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield {"text": json.loads(line)["text"]}
+    else:
+        with open(input_path, "r") as f:
+            lines = []
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                elif lines:
+                    yield {"text": "".join(lines)}
+                    lines = []
+            if lines:
+                yield {"text": "".join(lines)}
+
+def imap_bounded(pool, fn, iterable, window=1024, chunksize=16):
+    # Pool.imap drains its input as fast as it can, feed it bounded slices so streaming stays lazy
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, window))
+        if not chunk:
+            return
+        yield from pool.imap(fn, chunk, chunksize=chunksize)
+
+def load_manifest(out_dir, config):
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"config": config, "shards": [], "next_doc": 0, "next_doc_offset": 0, "complete": False}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    assert manifest["config"] == config, f"{path} was written with a different configuration: {manifest['config']}"
+    return manifest
+
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def shard_documents(docs, out_dir, config, nprocs=1, batch_size=0):
+    """
+    Tokenizes docs into shards of config["shard_size"] tokens in out_dir, the first
+    config["val_shards"] shards are the val split. The manifest records every completed
+    shard plus the document (and token offset within it) where the next shard begins,
+    so calling this again with the same docs resumes instead of starting over.
+    batch_size > 0 selects the batched shared memory tokenizer, the output is identical.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir, config)
+    if manifest["complete"]:
+        print(f"{out_dir} is already complete with {len(manifest['shards'])} shards")
+        return manifest
+    size = config["shard_size"]
+    dtype = np.dtype(config["dtype"])
+    shard_index = len(manifest["shards"])
+    doc_index = manifest["next_doc"]
+    token_offset = manifest["next_doc_offset"]
+    if shard_index > 0:
+        print(f"resuming at shard {shard_index}, document {doc_index}")
+
+    def flush(tokens_np, next_doc, next_doc_offset, complete=False):
+        split = "val" if shard_index < config["val_shards"] else "train"
+        filename = f"{config['prefix']}_{split}_{shard_index:06d}.npy"
+        write_datafile(os.path.join(out_dir, filename), tokens_np)
+        info = write_index(os.path.join(out_dir, filename), tokens_np)
+        manifest["shards"].append({"filename": filename, "split": split, **info})
+        manifest["next_doc"] = next_doc
+        manifest["next_doc_offset"] = next_doc_offset
+        manifest["complete"] = complete
+        save_manifest(out_dir, manifest)
 
-# tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
-nprocs = max(1, os.cpu_count()//2)
-with mp.Pool(nprocs) as pool:
-    shard_index = 0
     # preallocate buffer to hold current shard
-    all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
+    all_tokens_np = np.empty((size,), dtype=dtype)
     token_count = 0
     progress_bar = None
-    for tokens in pool.imap(tokenize, fw, chunksize=16):
-
-        # is there enough space in the current shard for the new tokens?
-        if token_count + len(tokens) < shard_size:
-            # simply append tokens to current shard
-            all_tokens_np[token_count:token_count+len(tokens)] = tokens
-            token_count += len(tokens)
-            # update progress bar
-            if progress_bar is None:
-                progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
-            progress_bar.update(len(tokens))
-        else:
-            # write the current shard and start a new one
-            split = "val" if shard_index == 0 else "train"
-            filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-            # split the document into whatever fits in this shard; the remainder goes to next one
-            remainder = shard_size - token_count
-            progress_bar.update(remainder)
-            all_tokens_np[token_count:token_count+remainder] = tokens[:remainder]
-            write_datafile(filename, all_tokens_np)
-            shard_index += 1
-            progress_bar = None
-            # populate the next shard with the leftovers of the current doc
-            all_tokens_np[0:len(tokens)-remainder] = tokens[remainder:]
-            token_count = len(tokens)-remainder
+    docs = itertools.islice(docs, doc_index, None)
+    with mp.Pool(nprocs) as pool:
+        for tokens in iterate_tokenized(pool, docs, dtype, batch_size):
+            pos = token_offset # tokens of this document already written by a previous run
+            token_offset = 0
+            while pos < len(tokens):
+                # split the document into whatever fits in this shard; the remainder goes to the next one
+                n = min(size - token_count, len(tokens) - pos)
+                all_tokens_np[token_count:token_count+n] = tokens[pos:pos+n]
+                token_count += n
+                pos += n
+                if progress_bar is None:
+                    progress_bar = tqdm(total=size, unit="tokens", desc=f"Shard {shard_index}")
+                progress_bar.update(n)
+                if token_count == size:
+                    if pos < len(tokens):
+                        flush(all_tokens_np, doc_index, pos)
+                    else:
+                        flush(all_tokens_np, doc_index + 1, 0)
+                    shard_index += 1
+                    token_count = 0
+                    progress_bar.close()
+                    progress_bar = None
+            doc_index += 1
 
     # write any remaining tokens as the last shard
     if token_count != 0:
-        split = "val" if shard_index == 0 else "train"
-        filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-        write_datafile(filename, all_tokens_np[:token_count])
\ No newline at end of file
+        flush(all_tokens_np[:token_count], doc_index, 0, complete=True)
+    else:
+        manifest["complete"] = True
+        save_manifest(out_dir, manifest)
+    if progress_bar is not None:
+        progress_bar.close()
+    return manifest
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, default=None, help="local .txt or .jsonl corpus, defaults to streaming fineweb-edu")
+    parser.add_argument("-n", "--remote_name", type=str, default=remote_name, help="fineweb-edu subset")
+    parser.add_argument("-o", "--out_dir", type=str, default=local_dir, help="output directory, relative to this file")
+    parser.add_argument("-s", "--shard_size", type=int, default=shard_size, help="tokens per shard")
+    parser.add_argument("--dtype", type=str, default="uint16", choices=["uint16", "uint32"])
+    parser.add_argument("--val_shards", type=int, default=1, help="number of leading shards used as the val split")
+    parser.add_argument("--prefix", type=str, default="edufineweb", help="shard filename prefix")
+    parser.add_argument("--nprocs", type=int, default=max(1, os.cpu_count()//2))
+    parser.add_argument("--batch_size", type=int, default=256, help="documents per tokenizer task, 0 tokenizes one document per task")
+    parser.add_argument("--index_only", action="store_true", help="only write missing sidecar indexes for existing shards in out_dir")
+    args = parser.parse_args()
+
+    # create the cache the local directory if it doesn't exist yet
+    DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), args.out_dir)
+    if args.index_only:
+        index_shards(DATA_CACHE_DIR)
+        exit(0)
+    config = {
+        "source": os.path.abspath(args.input) if args.input is not None else f"HuggingFaceFW/fineweb-edu/{args.remote_name}",
+        "tokenizer": enc.name,
+        "shard_size": args.shard_size,
+        "dtype": args.dtype,
+        "val_shards": args.val_shards,
+        "prefix": args.prefix,
+    }
+    shard_documents(iterate_documents(args.input, args.remote_name), DATA_CACHE_DIR, config, nprocs=args.nprocs, batch_size=args.batch_size)
@@ -4,9 +4,12 @@ import torch.nn as nn
 from torch.nn import functional as F
 from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import torch.distributed as dist
 import inspect
-from hellaswag import render_example, iterate_examples
+import os
+import torch.utils.checkpoint
+from hellaswag import evaluate_batched, CachedExamples
 def get_most_likely_row(tokens, mask, logits):
     # evaluate the autoregressive loss at all positions
     shift_logits = (logits[..., :-1, :]).contiguous()
@@ -26,10 +29,123 @@ def get_most_likely_row(tokens, mask, logits):
     pred_norm = avg_loss.argmin().item()
     return pred_norm
 
+try:
+    from torch.nn.attention.flex_attention import flex_attention, create_block_mask
+except ImportError: # torch < 2.5, packed sequences fall back to a boolean mask
+    flex_attention = create_block_mask = None
+_compiled_flex_attention = None
+
+def build_document_mask(doc_ids):
+    # block-diagonal causal mask for packed sequences: a token only attends to earlier tokens of its own document.
+    # on cuda this is a flex attention BlockMask, which only stores which tiles are live,
+    # elsewhere it is a (B, 1, T, T) boolean mask built once per batch and shared by every layer and head
+    B, T = doc_ids.size()
+    if flex_attention is not None and doc_ids.is_cuda:
+        def document_causal(b, h, q_idx, kv_idx):
+            return (doc_ids[b, q_idx] == doc_ids[b, kv_idx]) & (q_idx >= kv_idx)
+        return create_block_mask(document_causal, B, None, T, T, device=doc_ids.device)
+    causal = torch.ones(T, T, dtype=torch.bool, device=doc_ids.device).tril()
+    return ((doc_ids[:, :, None] == doc_ids[:, None, :]) & causal).unsqueeze(1)
+
+def document_attention(q, k, v, doc_mask):
+    global _compiled_flex_attention
+    if isinstance(doc_mask, torch.Tensor):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=doc_mask)
+    if _compiled_flex_attention is None:
+        _compiled_flex_attention = torch.compile(flex_attention) # eager flex attention is a slow reference path
+    return _compiled_flex_attention(q, k, v, block_mask=doc_mask)
+
+class KVCache:
+    # per-layer key/value buffers for incremental decoding, preallocated up to max_len
+    # so each decode step writes one column instead of re-concatenating the history
+    def __init__(self, n_layer, max_len):
+        self.n_layer = n_layer
+        self.max_len = max_len
+        self.k = [None]*n_layer
+        self.v = [None]*n_layer
+        self.pos = 0
+
+    def update(self, layer_idx, k, v):
+        B, nh, T, hs = k.size()
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = torch.empty((B, nh, self.max_len, hs), dtype=k.dtype, device=k.device)
+            self.v[layer_idx] = torch.empty((B, nh, self.max_len, hs), dtype=v.dtype, device=v.device)
+        assert self.pos + T <= self.max_len, "kv cache overflow"
+        self.k[layer_idx][:, :, self.pos:self.pos+T] = k
+        self.v[layer_idx][:, :, self.pos:self.pos+T] = v
+        return self.k[layer_idx][:, :, :self.pos+T], self.v[layer_idx][:, :, :self.pos+T]
+
+    def advance(self, T):
+        self.pos += T
+
+    def truncate(self, pos):
+        # roll back to an earlier length, the stale entries get overwritten on the next update
+        assert 0 <= pos <= self.pos
+        self.pos = pos
+
+class SlotKVCache:
+    # kv cache for continuous batching: max_slots independent sequences, each with its own length,
+    # select() picks the slots that the rows of the next forward belong to
+    def __init__(self, n_layer, max_slots, max_len):
+        self.n_layer = n_layer
+        self.max_len = max_len
+        self.k = [None]*n_layer
+        self.v = [None]*n_layer
+        self.lengths = torch.zeros(max_slots, dtype=torch.long)
+        self.slots = None
+        self.mask = None
+
+    @property
+    def pos(self):
+        return int(self.lengths[self.slots].max())
+
+    def select(self, slots):
+        self.slots = torch.as_tensor(slots, dtype=torch.long)
+
+    def positions(self, T):
+        # (B, T) position of every new token, for the position embeddings
+        return self.lengths[self.slots].unsqueeze(1) + torch.arange(T)
+
+    def update(self, layer_idx, k, v):
+        B, nh, T, hs = k.size()
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = torch.zeros((len(self.lengths), nh, self.max_len, hs), dtype=k.dtype, device=k.device)
+            self.v[layer_idx] = torch.zeros((len(self.lengths), nh, self.max_len, hs), dtype=v.dtype, device=v.device)
+        lengths = self.lengths[self.slots]
+        assert int(lengths.max()) + T <= self.max_len, "kv cache overflow"
+        slots, lengths = self.slots.to(k.device), lengths.to(k.device)
+        L = int(lengths.max()) + T
+        if B == 1:
+            # a prefill or a lone decode row: slice writes, and the returned keys/values are views
+            s = int(slots[0])
+            self.k[layer_idx][s, :, L-T:L] = k[0]
+            self.v[layer_idx][s, :, L-T:L] = v[0]
+        else:
+            # one scatter for all rows, the advanced indices put (B, T) first so k goes in as (B, T, nh, hs)
+            positions = lengths.unsqueeze(1) + torch.arange(T, device=k.device)
+            self.k[layer_idx][slots.unsqueeze(1), :, positions] = k.transpose(1, 2)
+            self.v[layer_idx][slots.unsqueeze(1), :, positions] = v.transpose(1, 2)
+        if layer_idx == 0 and B == 1 and L == T:
+            # prefill of one empty slot, plain causal attention
+            self.mask = None
+        elif layer_idx == 0:
+            # query t of row b sees the keys up to its own length + t, the rest of the slot is padding
+            self.mask = torch.arange(L, device=k.device).view(1, 1, 1, L) <= (lengths.view(B, 1, 1, 1) + torch.arange(T, device=k.device).view(1, 1, T, 1))
+        if B == 1:
+            return self.k[layer_idx][s:s+1, :, :L], self.v[layer_idx][s:s+1, :, :L]
+        return self.k[layer_idx][slots, :, :L], self.v[layer_idx][slots, :, :L]
+
+    def advance(self, T):
+        self.lengths[self.slots] += T
+
+    def free(self, slot):
+        self.lengths[slot] = 0
+
 class CausalSelfAttention(nn.Module):
-    def __init__(self,config):
+    def __init__(self,config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        self.layer_idx = layer_idx
 
         self.c_attn = nn.Linear(config.n_embd, 3*config.n_embd)
 
@@ -38,8 +154,10 @@ class CausalSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
 
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size)).view(1, 1, config.block_size, config.block_size))
-    def forward(self,x ):
+        # dense causal mask kept for checkpoint compatibility, attention itself uses is_causal/attn_mask and never reads it
+        if getattr(config, "mask_buffer", True):
+            self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size)).view(1, 1, config.block_size, config.block_size))
+    def forward(self,x, kv_cache=None, doc_mask=None):
         B,T,C = x.size()
         qkv = self.c_attn(x)
         q,k,v = qkv.split(self.n_embd, dim=2)
@@ -51,7 +169,24 @@ class CausalSelfAttention(nn.Module):
         #att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
         #att = F.softmax(att, dim=-1)
         #y = att @ v
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        if doc_mask is not None:
+            y = document_attention(q, k, v, doc_mask)
+        elif isinstance(kv_cache, SlotKVCache):
+            k, v = kv_cache.update(self.layer_idx, k, v)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=kv_cache.mask, is_causal=kv_cache.mask is None)
+        elif kv_cache is None or kv_cache.pos == 0:
+            if kv_cache is not None:
+                kv_cache.update(self.layer_idx, k, v)
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        else:
+            k, v = kv_cache.update(self.layer_idx, k, v)
+            if T == 1:
+                # a single new query attends to everything cached so far
+                y = F.scaled_dot_product_attention(q, k, v)
+            else:
+                # causal mask aligned to the bottom right: query i sees keys up to pos+i
+                mask = torch.ones(T, k.size(2), dtype=torch.bool, device=x.device).tril(diagonal=kv_cache.pos)
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
         y = y.transpose(1,2).contiguous().view(B,T,C)
         y = self.c_proj(y)
         return y
@@ -74,38 +209,76 @@ class MLP(nn.Module):
         return x
 
 class Block(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None, doc_mask=None):
+        x = x + self.attn(self.ln_1(x), kv_cache, doc_mask)
         x = x + self.mlp(self.ln_2(x))
         return x
 import tiktoken
 import numpy as np
+import warnings
 def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32)
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
+    # memory-map the uint16 shard instead of reading it, only the pages a batch touches get loaded
+    return np.load(filename, mmap_mode='r')
+def window_to_tensor(npt):
+    # copy just the B*T+1 window out of the mmap and widen it to int64
+    return torch.from_numpy(npt.astype(np.int64))
+def document_positions(x, eot=50256):
+    # for packed (B, T) token rows returns the document id and the position within its document of every token.
+    # every document starts with eot, so a new document begins at each eot (and at the start of each row)
+    B, T = x.size()
+    starts = x == eot
+    starts[:, 0] = True
+    doc_ids = torch.cumsum(starts, dim=1)
+    idx = torch.arange(T, device=x.device).expand(B, T)
+    start_idx = torch.cummax(torch.where(starts, idx, 0), dim=1).values
+    return doc_ids, idx - start_idx
 class DataLoaderLite:
-    def __init__(self,B,T,process_rank, num_processes, split):
+    def __init__(self,B,T,process_rank, num_processes, split, data_root="edu_fineweb10B", packed=False, eot=50256):
         self.B = B
         self.T = T
+        self.packed = packed # also return per-position document ids and positions, see document_positions()
+        self.eot = eot
         self.process_rank = process_rank
         self.num_processes = num_processes
-        data_root = "edu_fineweb10B"
         shards = os.listdir(data_root)
+        shards = [s for s in shards if s.endswith(".npy") and split in s] # skip manifests and in-progress temp files
         shards = sorted(shards)
         shards = [os.path.join(data_root,s) for s in shards]
         self.shards = shards 
-        if master_process:
-            print(f"found {len(shards)} shards for split {split}")
+        assert len(shards) > 0, f"no shards found for split {split}"
+        # sidecar indexes written by fineweb.py, None for shards that have none
+        self.index = [load_index(s) for s in shards]
+        self.num_tokens = None
+        if all(index is not None for index in self.index):
+            self.validate()
+            self.num_tokens = sum(index['num_tokens'] for index in self.index)
+        if process_rank == 0:
+            print(f"found {len(shards)} shards for split {split}" + (f" with {self.num_tokens:,} tokens" if self.num_tokens is not None else ""))
         self.reset()
+
+    def validate(self, checksums=False):
+        # the .npy header alone gives the shard length, so this reads no token data unless checksums=True
+        for shard, index in zip(self.shards, self.index):
+            tokens = load_tokens(shard)
+            assert len(tokens) == index['num_tokens'], f"{shard} has {len(tokens)} tokens, its index says {index['num_tokens']}"
+            if checksums:
+                assert shard_checksum(tokens) == index['checksum'], f"{shard} does not match its checksum"
+
+    def num_documents(self, shard):
+        return len(self.index[shard]['doc_starts'])
+
+    def document(self, shard, i):
+        # tokens of the i-th document starting in shard, eot first, looked up in O(1) from the index
+        starts = self.index[shard]['doc_starts']
+        end = starts[i+1] if i+1 < len(starts) else self.index[shard]['num_tokens']
+        return window_to_tensor(load_tokens(self.shards[shard])[starts[i]:end])
         
     def reset(self):
         self.current_shard = 0
@@ -113,16 +286,338 @@ class DataLoaderLite:
         self.current_position = self.B * self.T * self.process_rank
     def next_batch(self):
         B, T = self.B, self.T
-        buf = self.tokens[self.current_position:self.current_position+B*T+1]
+        buf = window_to_tensor(self.tokens[self.current_position:self.current_position+B*T+1])
         x = (buf[:-1]).view(B,T)
         y = (buf[1:]).view(B,T)
-        self.current_position += B*T
+        self.current_position += B*T*self.num_processes
 
         if self.current_position + (B*T*self.num_processes+1)>len(self.tokens):
             self.current_shard = (self.current_shard+1)% len(self.shards)
             self.tokens = load_tokens(self.shards[self.current_shard])
             self.current_position = B*T*self.process_rank
+        if self.packed:
+            return (x, y) + document_positions(x, self.eot)
         return x,y
+
+    def state_dict(self):
+        # cursor of the next batch this rank will read
+        return {'current_shard': self.current_shard, 'current_position': self.current_position}
+
+    def load_state_dict(self, state):
+        self.current_shard = state['current_shard']
+        self.current_position = state['current_position']
+        self.tokens = load_tokens(self.shards[self.current_shard])
+
+    def rank_state(self, state):
+        # this rank's cursor when resuming a run saved at a different world size:
+        # rank 0's cursor marks where the global token stream stopped
+        shard = state['current_shard']
+        position = state['current_position'] + self.B * self.T * self.process_rank
+        if position + self.B * self.T + 1 > len(load_tokens(self.shards[shard])):
+            shard, position = (shard + 1) % len(self.shards), self.B * self.T * self.process_rank
+        return {'current_shard': shard, 'current_position': position}
+def source_shards(path, split):
+    # token arrays of a mixture source: the split's .npy shards of a directory (memory-mapped),
+    # a single .npy shard, or a text file, tokenized once and kept in memory
+    if os.path.isdir(path):
+        shards = sorted(s for s in os.listdir(path) if s.endswith(".npy") and split in s)
+        assert len(shards) > 0, f"no shards found for split {split} in {path}"
+        return [load_tokens(os.path.join(path, s)) for s in shards]
+    if path.endswith(".npy"):
+        return [load_tokens(path)]
+    with open(path) as f:
+        return [np.array(tiktoken.get_encoding("gpt2").encode_ordinary(f.read()), dtype=np.uint16)]
+class MixtureLoader:
+    """
+    Drop-in for DataLoaderLite that samples every row of a batch from one of several weighted
+    sources. Each source is cut into non-overlapping windows of T+1 tokens and read in a shuffled
+    order: the shard order is permuted every epoch and so are the windows within each shard, so
+    only the rows of a batch are ever read from the memory-mapped shards.
+    The stream of sources and windows is global and depends only on the seed: all ranks draw the
+    same source choices for the B * num_processes rows of a step and each takes its own B rows,
+    so ranks never share a window and the state is the same on every rank and at any world size.
+    """
+    choice_rows = 65536 # source choices are drawn in blocks of this many rows, each with its own rng
+    plan_tokens = 2**21 # the rows of this many tokens worth of steps are looked up and gathered in one vectorized pass
+
+    def __init__(self, B, T, process_rank, num_processes, sources, split="train", seed=1337, packed=False, eot=50256):
+        # sources is a list of (path, weight), the weights are normalized
+        self.B = B
+        self.T = T
+        self.packed = packed
+        self.eot = eot
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.seed = seed
+        self.plan_steps = max(1, self.plan_tokens // (B * T))
+        self.names = [path for path, _ in sources]
+        weights = np.array([weight for _, weight in sources], dtype=np.float64)
+        assert len(sources) > 0 and (weights >= 0).all() and weights.sum() > 0, "mixture weights must be non-negative and not all zero"
+        self.weights = weights / weights.sum()
+        self.shards = [source_shards(path, split) for path in self.names]
+        self.shard_windows = [np.array([(len(t) - 1) // T for t in shards]) for shards in self.shards]
+        self.num_windows = [int(n.sum()) for n in self.shard_windows]
+        for name, n, w in zip(self.names, self.num_windows, self.weights):
+            assert n > 0 or w == 0, f"{name} has no window of {T+1} tokens"
+        # (windows, T+1) strided views of every shard, window i is tokens i*T..(i+1)*T, so a run of rows is one gather
+        # that brings in inputs and targets together. they're tensors so index_select can gather into the plan buffer
+        # without a temporary, still reading lazily (torch warns that the memory maps are read-only, they're only read)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            self.views = [[torch.from_numpy(np.lib.stride_tricks.sliding_window_view(np.asarray(t)[:n*T+1], T+1)[::T]) for t, n in zip(shards, windows)]
+                          for shards, windows in zip(self.shards, self.shard_windows)]
+        self._choices = (None, None) # (block, source of every row in it)
+        # per source, the current epoch's shard order and the current shard's window permutation
+        self._epoch_order = [(None, None, None)] * len(sources) # (epoch, shard order, cumulative windows in that order)
+        self._window_order = [(None, None)] * len(sources) # ((epoch, shard), window permutation)
+        # the T+1 token rows of the planned steps, in the widest token dtype of the sources (uint16 for gpt2
+        # shards, uint32 for larger vocabularies), reused by every plan so no fresh pages get faulted in
+        dtype = np.result_type(*[t.dtype for shards in self.shards for t in shards])
+        self._rows = np.empty((self.plan_steps * B, T + 1), dtype=dtype)
+        self._rows_t = torch.from_numpy(self._rows)
+        if process_rank == 0:
+            for name, shards, n, w in zip(self.names, self.shards, self.num_windows, self.weights):
+                print(f"mixture source {name}: {len(shards)} shards, {n:,} windows of {T+1} tokens, weight {w:.3f}")
+        self.reset()
+
+    def reset(self):
+        self.rows = 0 # global rows drawn so far
+        self.counts = np.zeros(len(self.names), dtype=np.int64) # windows drawn so far from each source
+        self._plan = None
+
+    def choices(self, start, n):
+        # source of global rows start..start+n
+        out = []
+        while n > 0:
+            block, offset = divmod(start, self.choice_rows)
+            if self._choices[0] != block:
+                rng = np.random.default_rng([self.seed, block])
+                self._choices = (block, rng.choice(len(self.weights), size=self.choice_rows, p=self.weights))
+            take = min(n, self.choice_rows - offset)
+            out.append(self._choices[1][offset:offset+take])
+            start, n = start + take, n - take
+        return np.concatenate(out)
+
+    def shard_order(self, source, epoch):
+        # shard permutation of an epoch and the cumulative window counts in that order
+        if self._epoch_order[source][0] != epoch:
+            n = self.shard_windows[source]
+            order = np.random.default_rng([self.seed, source, epoch]).permutation(len(n))
+            self._epoch_order[source] = (epoch, order, np.cumsum(n[order]))
+        return self._epoch_order[source][1:]
+
+    def window_order(self, source, epoch, shard):
+        if self._window_order[source][0] != (epoch, shard):
+            perm = np.random.default_rng([self.seed, source, epoch, shard, 1]).permutation(self.shard_windows[source][shard])
+            self._window_order[source] = ((epoch, shard), perm)
+        return self._window_order[source][1]
+
+    def windows(self, source, w):
+        """
+        Splits the increasing window numbers w drawn from source into runs within one epoch and one
+        shard, yields (shard, slice of w, rows of those windows within the shard) for each run
+        """
+        n = self.shard_windows[source]
+        epochs, j = np.divmod(w, self.num_windows[source])
+        first = 0
+        while first < len(w):
+            epoch = int(epochs[first])
+            order, cum = self.shard_order(source, epoch)
+            i = int(np.searchsorted(cum, j[first], side='right'))
+            last = int(np.searchsorted(w, epoch * self.num_windows[source] + cum[i])) # w is increasing
+            shard = int(order[i])
+            yield shard, slice(first, last), self.window_order(source, epoch, shard)[j[first:last] - (cum[i] - n[shard])]
+            first = last
+
+    def plan(self):
+        # fills _rows with this rank's rows of the next plan_steps steps, returns the counts after each step
+        step_rows = self.B * self.num_processes
+        sources = self.choices(self.rows, self.plan_steps * step_rows)
+        # window number of every row: the source's count so far plus the earlier rows from the same source
+        cum = np.cumsum(sources[:, None] == np.arange(len(self.names)), axis=0)
+        windows = self.counts[sources] + cum[np.arange(len(sources)), sources] - 1
+        step_counts = self.counts + cum[step_rows-1::step_rows]
+        mine = np.arange(len(sources)) // self.B % self.num_processes == self.process_rank
+        sources, windows = sources[mine], windows[mine]
+        # one gather per run, only the pages of these rows are read from the mmap. the runs of the source with the
+        # most rows go first and straight into the block of plan rows each one spans (a row of another source in
+        # between gets a copy of the row before it), the other sources' rows are then scattered over those
+        order = np.argsort(-np.bincount(sources, minlength=len(self.names)), kind='stable').tolist()
+        for s in order:
+            rows = np.flatnonzero(sources == s)
+            for shard, run, rows_in_shard in self.windows(s, windows[rows]):
+                view, dest = self.views[s][shard], rows[run]
+                if s == order[0] and view.dtype == self._rows_t.dtype:
+                    block = np.zeros(dest[-1] - dest[0] + 1, dtype=bool)
+                    block[dest - dest[0]] = True
+                    index = torch.from_numpy(rows_in_shard[np.cumsum(block) - 1])
+                    torch.index_select(view, 0, index, out=self._rows_t[dest[0]:dest[-1]+1])
+                else:
+                    self._rows[dest] = view.numpy()[rows_in_shard]
+        return step_counts
+
+    def next_batch(self):
+        B = self.B
+        if self._plan is None:
+            self._plan = (self.plan(), 0)
+        step_counts, step = self._plan
+        # one cast of the (B, T+1) rows into a fresh int64 buffer (the plan buffer gets overwritten by the next
+        # plan), x and y are views of it like DataLoaderLite's. the rows aren't adjacent in a shard, so unlike
+        # there the views are strided, forward reshapes its targets and PrefetchLoader pins contiguous copies
+        buf = self._rows[step*B:(step+1)*B].astype(np.int64)
+        x, y = torch.from_numpy(buf[:, :-1]), torch.from_numpy(buf[:, 1:])
+        self.rows += B * self.num_processes
+        self.counts = step_counts[step]
+        self._plan = (step_counts, step + 1) if step + 1 < self.plan_steps else None
+        if self.packed:
+            return (x, y) + document_positions(x, self.eot)
+        return x, y
+
+    def epochs(self, state=None):
+        # completed passes over each source, fractional
+        counts = np.array((state or self.state_dict())['counts'])
+        return [float(c / n) if n else 0.0 for c, n in zip(counts, self.num_windows)]
+
+    def ratios(self, state=None):
+        # realized share of the rows drawn so far from each source
+        counts = np.array((state or self.state_dict())['counts'])
+        return counts / max(1, counts.sum())
+
+    def describe(self, state=None):
+        return " | ".join(f"{name} {r:.3f} (weight {w:.3f}, epoch {e:.2f})" for name, r, w, e in
+                          zip(self.names, self.ratios(state), self.weights, self.epochs(state)))
+
+    def state_dict(self):
+        return {'rows': self.rows, 'counts': self.counts.tolist()}
+
+    def load_state_dict(self, state):
+        self.rows = state['rows']
+        self.counts = np.array(state['counts'], dtype=np.int64)
+        self._plan = None
+
+    def rank_state(self, state):
+        # the state is global, it resumes at any world size as is
+        return dict(state)
+def parse_mixture(spec):
+    # "edu_fineweb10B:0.9,input.txt:0.1" -> [("edu_fineweb10B", 0.9), ("input.txt", 0.1)]
+    sources = []
+    for item in spec.split(","):
+        path, weight = item.rsplit(":", 1)
+        sources.append((path, float(weight)))
+    return sources
+class ValidationSet:
+    """
+    A fixed val set: the first num_tokens tokens of the val shards cut into non-overlapping
+    windows of T+1 tokens, window i belongs to rank i % num_processes. Each rank loads its
+    windows once and keeps them resident on device, and the loss is token-weighted over the
+    whole set, so it comes out the same at any world size.
+    """
+    def __init__(self, T, num_tokens, process_rank, num_processes, data_root="edu_fineweb10B", device="cpu"):
+        self.T = T
+        shards = sorted(s for s in os.listdir(data_root) if s.endswith(".npy") and "val" in s)
+        assert len(shards) > 0, f"no val shards found in {data_root}"
+        max_windows = num_tokens // T
+        windows = []
+        self.num_windows = 0
+        for shard in shards:
+            tokens = load_tokens(os.path.join(data_root, shard))
+            for start in range(0, len(tokens) - T, T):
+                if self.num_windows == max_windows:
+                    break
+                if self.num_windows % num_processes == process_rank:
+                    windows.append(tokens[start:start+T+1])
+                self.num_windows += 1
+        self.num_tokens = self.num_windows * T
+        tokens = window_to_tensor(np.stack(windows)) if windows else torch.zeros((0, T+1), dtype=torch.long)
+        self.x = tokens[:, :-1].contiguous().to(device)
+        self.y = tokens[:, 1:].contiguous().to(device)
+        if process_rank == 0:
+            print(f"validation set: {self.num_tokens:,} tokens from {len(shards)} val shards" + (f" ({num_tokens:,} requested)" if self.num_tokens < max_windows * T else ""))
+
+    def batches(self, B):
+        for i in range(0, len(self.x), B):
+            yield self.x[i:i+B], self.y[i:i+B]
+
+import threading
+import queue
+import time
+from fineweb import load_index, shard_checksum
+from profiler import StepProfiler, default_peak_flops
+from autotune import plan_micro_batch, measure_step_memory
+from checkpoint import get_rng_state, set_rng_state, save_checkpoint, load_checkpoint, latest_checkpoint, optimizer_shard, shard_filename, CheckpointWriter
+class PrefetchLoader:
+    # wraps a DataLoaderLite and fills a bounded queue of ready batches (tuples of tensors) from a background thread,
+    # so loading the next batch overlaps with forward/backward on the current one
+    def __init__(self, loader, device="cpu", depth=4, pin_memory=True):
+        self.loader = loader
+        self.B, self.T = loader.B, loader.T
+        self.device = device
+        self.depth = depth
+        self.pin_memory = pin_memory and "cuda" in str(device) and torch.cuda.is_available()
+        self.stall_time = 0.0 # seconds next_batch spent waiting on an empty queue
+        self.num_batches = 0
+        self.start()
+
+    def start(self):
+        # the wrapped loader runs ahead of training, so remember the cursor of the next unconsumed batch
+        self.consumed_state = self.loader.state_dict()
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # blocks while the queue is full, but gives up once close() asks the worker to stop
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = self.loader.next_batch()
+                state = self.loader.state_dict()
+                if self.pin_memory:
+                    # contiguous pinned copies: pin_memory() keeps a strided tensor's layout (MixtureLoader's
+                    # x and y) and its copy to the device would go through a pageable temporary
+                    batch = tuple(torch.empty(t.shape, dtype=t.dtype, pin_memory=True).copy_(t) for t in batch)
+                self._put((batch, state))
+        except Exception as e:
+            self._put(e) # surface loader errors in the training loop instead of hanging it
+
+    def next_batch(self):
+        t0 = time.time()
+        item = self.queue.get()
+        self.stall_time += time.time() - t0
+        self.num_batches += 1
+        if isinstance(item, Exception):
+            raise item
+        batch, self.consumed_state = item
+        return tuple(t.to(self.device, non_blocking=self.pin_memory) for t in batch)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return dict(queue_depth=self.queue_depth(), stall_time=self.stall_time, num_batches=self.num_batches,
+                    avg_stall_ms=1000*self.stall_time/max(1, self.num_batches))
+
+    def state_dict(self):
+        return dict(self.consumed_state)
+
+    def load_state_dict(self, state):
+        # drop whatever was prefetched from the old position and restart from the restored cursor
+        self.close()
+        self.loader.load_state_dict(state)
+        self.start()
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
 @dataclass
 class ModelConfig:
     block_size: int = 3048
@@ -130,21 +625,28 @@ class ModelConfig:
     n_layer: int = 12
     n_head: int = 12
     n_embd: int = 768
+    mask_buffer: bool = True # False drops the unused block_size x block_size attn.bias buffer from every layer
 
 class GPT(nn.Module):
-    def __init__(self,config):
+    def __init__(self,config, init_weights=True):
+        # init_weights=False skips all normal_ init (GPT's own and nn.Embedding's default) for a model whose
+        # weights get loaded over it, normal_ on meta tensors falls back to a python decomposition that
+        # costs over a second on first use
         super().__init__()
         self.config = config
+        embedding = lambda n: nn.Embedding(n, config.n_embd, _weight=None if init_weights else torch.empty(n, config.n_embd))
         self.transformer = nn.ModuleDict(dict(
-            wte = nn.Embedding(config.vocab_size, config.n_embd),
-            wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            wte = embedding(config.vocab_size),
+            wpe = embedding(config.block_size),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = nn.LayerNorm(config.n_embd)
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
 
         self.transformer.wte.weight = self.lm_head.weight
-        self.apply(self._init_weights)
+        if init_weights:
+            self.apply(self._init_weights)
+        self.checkpoint_every = 0 # activation checkpointing, see set_activation_checkpointing
     def _init_weights(self, module):
         if isinstance(module,nn.Linear):
             std = 0.02
@@ -156,33 +658,186 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, doc_ids=None, pos=None, loss_chunk=0, reduction="mean"):
+        # doc_ids and pos (both (B, T), from a packed DataLoaderLite) restrict attention to each
+        # token's own document and restart the position embeddings at every document.
+        # loss_chunk > 0 computes the loss with chunked_loss and returns no logits,
+        # reduction "none" returns the (B, T) per-token losses instead of their mean
         B,T = idx.size()
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device)
+        start = kv_cache.pos if kv_cache is not None else 0
+        assert start + T <= self.config.block_size, f"sequence of length {start + T} exceeds block_size {self.config.block_size}"
+        assert doc_ids is None or kv_cache is None, "packed sequences are not supported with a kv cache"
+        if pos is None and isinstance(kv_cache, SlotKVCache):
+            pos = kv_cache.positions(T).to(idx.device)
+        if pos is None:
+            pos = torch.arange(start, start + T, dtype=torch.long, device=idx.device)
         pos_emb = self.transformer.wpe(pos)
         tok_emb = self.transformer.wte(idx)
         x = tok_emb + pos_emb
-        for block in self.transformer.h:
-            x = block(x)
+        doc_mask = build_document_mask(doc_ids) if doc_ids is not None else None
+        for i, block in enumerate(self.transformer.h):
+            if self.checkpoint_every and i % self.checkpoint_every == 0 and self.training and torch.is_grad_enabled():
+                # keep only the block input and recompute its activations during backward
+                x = torch.utils.checkpoint.checkpoint(block, x, kv_cache, doc_mask, use_reentrant=False)
+            else:
+                x = block(x, kv_cache, doc_mask)
+        if kv_cache is not None:
+            kv_cache.advance(T)
         x = self.transformer.ln_f(x)
+        if targets is not None and loss_chunk:
+            return None, self.chunked_loss(x, targets, loss_chunk, reduction)
         logits = self.lm_head(x)
         loss = None
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), reduction=reduction)
+            if reduction == "none":
+                loss = loss.view(targets.shape)
         return logits, loss
+
+    def chunked_loss(self, x, targets, chunk_size, reduction="mean"):
+        """
+        lm_head and cross entropy over chunk_size tokens at a time, so the (B, T, vocab) logits
+        never exist at once. With grad enabled every chunk is checkpointed: backward recomputes
+        its logits instead of keeping them, one more lm_head matmul per chunk.
+        """
+        flat_x, flat_targets = x.reshape(-1, x.size(-1)), targets.reshape(-1)
+        def chunk_loss(x, targets):
+            return F.cross_entropy(self.lm_head(x).float(), targets, reduction="none" if reduction == "none" else "sum")
+        losses = []
+        for i in range(0, flat_targets.numel(), chunk_size):
+            args = (flat_x[i:i+chunk_size], flat_targets[i:i+chunk_size])
+            if torch.is_grad_enabled():
+                losses.append(torch.utils.checkpoint.checkpoint(chunk_loss, *args, use_reentrant=False))
+            else:
+                losses.append(chunk_loss(*args))
+        if reduction == "none":
+            return torch.cat(losses).view(targets.shape)
+        return torch.stack(losses).sum() / flat_targets.numel()
+
+    def set_activation_checkpointing(self, every):
+        # 0 disables it, N checkpoints every N-th block (layers 0, N, 2N, ...), 1 checkpoints all blocks
+        assert every >= 0
+        self.checkpoint_every = every
+
+    def load_state_dict(self, state_dict, strict=True, assign=False):
+        # accepts state dicts saved from torch.compile'd models and with or without the attn.bias buffers
+        state_dict = {k.removeprefix("_orig_mod."): v for k, v in state_dict.items()}
+        has_bias = getattr(self.config, "mask_buffer", True)
+        state_dict = {k: v for k, v in state_dict.items() if has_bias or not k.endswith(".attn.bias")}
+        if has_bias:
+            own = self.state_dict()
+            for k in own:
+                if k.endswith(".attn.bias") and k not in state_dict:
+                    state_dict[k] = own[k]
+        return super().load_state_dict(state_dict, strict=strict, assign=assign)
+
+    def flops_per_token(self, T):
+        # PaLM appendix B estimate of training flops per token: 6N for the weight matmuls
+        # (forward + backward) plus the attention scores, which grow with the context length T
+        cfg = self.config
+        N = sum(p.numel() for p in self.parameters()) - self.transformer.wpe.weight.numel()
+        L, H, Q = cfg.n_layer, cfg.n_head, cfg.n_embd // cfg.n_head
+        return 6*N + 12*L*H*Q*T
+
+    def next_token_probs(self, logits, temperature=1.0, top_k=None):
+        # the (B, vocab) distribution sample_next draws from, one-hot on the argmax at temperature 0
+        if temperature == 0.0:
+            return F.one_hot(logits.argmax(dim=-1), logits.size(-1)).float()
+        probs = F.softmax(logits / temperature, dim=-1)
+        if top_k is not None:
+            topk_probs, topk_indices = torch.topk(probs, min(top_k, probs.size(-1)), dim=-1)
+            probs = torch.zeros_like(probs).scatter_(-1, topk_indices, topk_probs)
+            probs = probs / probs.sum(dim=-1, keepdim=True)
+        return probs
+
+    def sample_next(self, logits, temperature=1.0, top_k=None, generator=None):
+        # logits is (B, vocab) for the last position, returns (B, 1) sampled tokens
+        if temperature == 0.0:
+            return logits.argmax(dim=-1, keepdim=True)
+        probs = F.softmax(logits / temperature, dim=-1)
+        if top_k is None:
+            return torch.multinomial(probs, 1, generator=generator)
+        topk_probs, topk_indices = torch.topk(probs, min(top_k, probs.size(-1)), dim=-1)
+        ix = torch.multinomial(topk_probs, 1, generator=generator)
+        return torch.gather(topk_indices, -1, ix)
+
+    @torch.no_grad()
+    def generate_speculative(self, draft, idx, max_new_tokens, k=4, temperature=1.0, top_k=None, generator=None):
+        """
+        Speculative sampling: the small draft model proposes k tokens one at a time, this model
+        scores all of them in a single forward, and each proposal is accepted with probability
+        min(1, p/q). The first rejected position is resampled from max(0, p - q), and when all k
+        are accepted one more token comes from p for free. The output is distributed exactly as
+        generate() with the same temperature and top_k. idx is a (1, T) prompt, the draft must
+        share the vocabulary. Returns the (1, T + max_new_tokens) tokens and acceptance stats.
+        """
+        assert idx.size(0) == 1, "speculative decoding runs one sequence at a time"
+        max_len = idx.size(1) + max_new_tokens
+        assert max_len <= min(self.config.block_size, draft.config.block_size), "the kv caches cannot slide past block_size"
+        # both caches always hold every token but the last one of idx, that one is fed on the next round
+        target_cache = KVCache(self.config.n_layer, max_len)
+        draft_cache = KVCache(draft.config.n_layer, max_len)
+        stats = {"target_forwards": 0, "drafted": 0, "accepted": 0}
+        while idx.size(1) < max_len:
+            n = min(k, max_len - idx.size(1) - 1) # the round adds at most n + 1 tokens
+            x = idx[:, draft_cache.pos:]
+            drafted, draft_probs = [], []
+            for _ in range(n):
+                logits, _ = draft(x, kv_cache=draft_cache)
+                q = self.next_token_probs(logits[:, -1, :].float(), temperature, top_k)
+                x = torch.multinomial(q, 1, generator=generator)
+                drafted.append(x)
+                draft_probs.append(q)
+            logits, _ = self(torch.cat([idx[:, target_cache.pos:]] + drafted, dim=1), kv_cache=target_cache)
+            p = self.next_token_probs(logits[0, -(n+1):, :].float(), temperature, top_k) # (n+1, vocab)
+            stats["target_forwards"] += 1
+            stats["drafted"] += n
+            new = []
+            for i in range(n):
+                token = drafted[i][0, 0]
+                q = draft_probs[i][0]
+                r = torch.rand((), generator=generator, device=q.device)
+                if r < torch.clamp(p[i, token] / q[token], max=1.0):
+                    new.append(token)
+                    continue
+                residual = torch.clamp(p[i] - q, min=0.0)
+                new.append(torch.multinomial(residual / residual.sum(), 1, generator=generator)[0])
+                break
+            else:
+                new.append(torch.multinomial(p[n], 1, generator=generator)[0]) # all accepted, sample the bonus token
+            stats["accepted"] += len(new) - 1 # the last token is the resampled or bonus one
+            idx = torch.cat((idx, torch.stack(new).view(1, -1)), dim=1)
+            # drop the cache entries of rejected proposals
+            target_cache.truncate(idx.size(1) - 1)
+            draft_cache.truncate(min(draft_cache.pos, idx.size(1) - 1))
+        return idx, stats
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, generator=None, use_cache=True):
+        # idx is (B, T) prompt tokens, returns (B, T + max_new_tokens)
+        # with use_cache only the new token runs through the model at each step
+        if use_cache and idx.size(1) + max_new_tokens > self.config.block_size:
+            use_cache = False # the cache cannot slide, fall back to recomputing a cropped window
+        kv_cache = KVCache(self.config.n_layer, idx.size(1) + max_new_tokens) if use_cache else None
+        x = idx
+        for _ in range(max_new_tokens):
+            if kv_cache is None:
+                logits, _ = self(idx[:, -self.config.block_size:])
+            else:
+                logits, _ = self(x, kv_cache=kv_cache)
+            x = self.sample_next(logits[:, -1, :].float(), temperature, top_k, generator)
+            idx = torch.cat((idx, x), dim=1)
+        return idx
+
     @classmethod
-    def from_pretrained(cls, model_type):
-        assert model_type in ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"]
+    def from_pretrained(cls, model_type, fast=True):
+        # fast builds on the meta device and memory-maps a native copy of the weights converted once into
+        # pretrained/, otherwise a randomly initialized GPT gets the weights copied over from the HF model
+        if fast:
+            return cls.from_checkpoint(convert_pretrained(model_type))
         from transformers import GPT2LMHeadModel
 
-        config_args = {
-            "gpt2": dict(n_layer=12, n_head=12, n_embd=768),
-            "gpt2-medium": dict(n_layer=24, n_head=16, n_embd=1024),
-            "gpt2-large": dict(n_layer=36, n_head=20, n_embd=1280),
-            "gpt2-xl": dict(n_layer=48, n_head=25, n_embd=1600)
-        }[model_type]
-        config_args['vocab_size'] = 50257
-        config_args['block_size'] = 1024
+        config_args = pretrained_config(model_type)
 
         config=ModelConfig(**config_args)
         model = GPT(config)
@@ -207,7 +862,26 @@ class GPT(nn.Module):
                     sd[k].copy_(sd_hf[k])
         return model 
     
-    def configure_optimizers(self, weight_decay, learning_rate,device):
+    @classmethod
+    def from_checkpoint(cls, path, device="cpu"):
+        """
+        Loads a trainer checkpoint (file or sharded directory) or a file from convert_pretrained.
+        The model is built on the meta device, so no time or memory goes into random init, and
+        the weights are assigned straight from the memory-mapped file: pages are read on first touch
+        and never copied on cpu.
+        """
+        checkpoint = load_checkpoint(path, mmap=True)
+        config = checkpoint['config']
+        if isinstance(config, dict):
+            config = ModelConfig(**config)
+        config.mask_buffer = False # nothing reads the dense mask, and it is not in the file
+        with torch.device("meta"):
+            model = cls(config, init_weights=False)
+        model.load_state_dict(checkpoint['model'], assign=True)
+        model.transformer.wte.weight = model.lm_head.weight # assign gave the tied pair two separate parameters
+        return model.to(device)
+
+    def configure_optimizers(self, weight_decay, learning_rate,device, zero=False):
         param_dict = {pn:p for pn, p in self.named_parameters()}
         param_dict = {pn:p for pn, p in param_dict.items() if p.requires_grad}
         decay_params = [p for n, p in param_dict.items() if p.dim() >= 2]
@@ -223,187 +897,503 @@ class GPT(nn.Module):
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and 'cuda' in device
         print(f"using fused adam = {use_fused}")
+        if zero:
+            # ZeRO-1: every rank keeps the AdamW moments of its own partition of the parameters only,
+            # steps that partition and broadcasts the updated parameters to the other ranks
+            print(f"using zero sharded optimizer")
+            return ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
         optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
         return optimizer
-from torch.distributed import init_process_group, destroy_process_group
-from torch.nn.parallel import DistributedDataParallel as DDP
-import os 
-ddp = int(os.environ.get("RANK", -1)) != -1
-backend='nccl'
-if ddp:
-    init_process_group(backend=backend)
-    ddp_rank = int(os.environ['RANK'])
-    ddp_local_rank = int(os.environ['LOCAL_RANK'])
-    ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device= f"cuda:{ddp_local_rank}"
-    torch.cuda.set_device(device)
-    master_process = ddp_rank == 0
-else:
-    ddp_rank = 0
-    ddp_local_rank = 0
-    ddp_world_size = 1
-    master_process = True
-    device = "cuda"
-num_return_sequences = 5
-max_length = 30
-
-total_batch_size = 524288
-B=64
-T=1024
-grad_accum_steps = total_batch_size // (B*T*ddp_world_size)
-if master_process:
-    print(f"grad_accum_steps:{grad_accum_steps}")
-
-print(f"total desired batch size:{total_batch_size}")
-print(f"grad_accum_steps:{grad_accum_steps}")
-
-train_loader = DataLoaderLite(B=16, T=1024,process_rank=ddp_rank,num_processes=ddp_world_size, split="train")
-val_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="val")
-torch.set_float32_matmul_precision('high')
-model = GPT(ModelConfig(vocab_size=50304))
-model.to("cuda")
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model
-max_lr = 6e-4*3
-min_lr = max_lr *0.1
-warmup_steps = 100
-max_steps = 19073*2
-
-def get_lr(it):
-    if it < warmup_steps:
-        return max_lr*(it+1)/warmup_steps
-    if it > max_steps:
-        return min_lr 
-    decay_ratio = (it - warmup_steps) / (max_steps - warmup_steps)
-    coeff = 0.5*(1.0+math.cos(math.pi*decay_ratio))
-    return min_lr + coeff*(max_lr - min_lr)
-optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device="cuda")
-import time 
-log_dir = "log"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"log.txt")
-with open(log_file, "w") as f: # open for writing to clear the file
-    pass
-for step in range(max_steps):
-    t0 = time.time()
-    last_step = (step == max_steps - 1)
-
-    if step % 100 == 0:
+import json
+import hashlib
+import glob
+PRETRAINED_CACHE_DIR = os.path.join(os.path.dirname(__file__), "pretrained")
+
+def pretrained_config(model_type):
+    # ModelConfig arguments of a gpt2 variant, or of a local HF GPT-2 directory
+    if os.path.isdir(model_type):
+        with open(os.path.join(model_type, "config.json")) as f:
+            hf = json.load(f)
+        return dict(n_layer=hf['n_layer'], n_head=hf['n_head'], n_embd=hf['n_embd'], vocab_size=hf['vocab_size'], block_size=hf['n_positions'])
+    assert model_type in ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl"]
+    config_args = {
+        "gpt2": dict(n_layer=12, n_head=12, n_embd=768),
+        "gpt2-medium": dict(n_layer=24, n_head=16, n_embd=1024),
+        "gpt2-large": dict(n_layer=36, n_head=20, n_embd=1280),
+        "gpt2-xl": dict(n_layer=48, n_head=25, n_embd=1600)
+    }[model_type]
+    config_args['vocab_size'] = 50257
+    config_args['block_size'] = 1024
+    return config_args
+
+def pretrained_weights(model_type):
+    # model.safetensors of a local HF directory, or of a hub repo (from the local hub cache when it is there)
+    if os.path.isdir(model_type):
+        return os.path.join(model_type, "model.safetensors")
+    from huggingface_hub import hf_hub_download, try_to_load_from_cache
+    cached = try_to_load_from_cache(model_type, "model.safetensors")
+    return cached if isinstance(cached, str) else hf_hub_download(model_type, "model.safetensors")
+
+def convert_pretrained(model_type, cache_dir=PRETRAINED_CACHE_DIR):
+    """
+    Converts the HF GPT-2 safetensors (Conv1D weights, stored transposed) into a native checkpoint
+    once and returns its path, reading one tensor at a time and never instantiating the HF model.
+    The cached file is named after the source (a hub repo id or the absolute path of a local directory)
+    and the version of its weights file (real path, size and mtime), so a local directory and a hub repo
+    of the same name don't collide and changed weights get converted again, replacing the old conversion
+    """
+    weights = pretrained_weights(model_type)
+    stat = os.stat(weights)
+    sha1 = lambda s: hashlib.sha1(s.encode()).hexdigest()[:10]
+    source = sha1(os.path.abspath(model_type) if os.path.isdir(model_type) else model_type)
+    prefix = os.path.join(cache_dir, f"{os.path.basename(os.path.normpath(model_type))}-{source}-")
+    path = prefix + sha1(f"{os.path.realpath(weights)}:{stat.st_size}:{stat.st_mtime_ns}") + ".pt"
+    if os.path.exists(path):
+        return path
+    for stale in glob.glob(glob.escape(prefix) + "*.pt"):
+        os.remove(stale)
+    from safetensors import safe_open
+    transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
+    sd = {}
+    with safe_open(weights, framework="pt") as f:
+        for k in f.keys():
+            if k.endswith(".attn.masked_bias") or k.endswith(".attn.bias"):
+                continue
+            v = f.get_tensor(k)
+            k = k if k.startswith(("transformer.", "lm_head.")) else "transformer." + k # the hub files store GPT2Model keys
+            sd[k] = v.t().contiguous() if any(k.endswith(w) for w in transposed) else v
+    sd.setdefault("lm_head.weight", sd["transformer.wte.weight"]) # tied, saved once
+    os.makedirs(cache_dir, exist_ok=True)
+    save_checkpoint({'config': pretrained_config(model_type), 'model': sd}, path)
+    return path
+
+import argparse
+import contextlib
+from dataclasses import asdict, fields, replace
+
+@dataclass
+class TrainConfig:
+    # data
+    data_root: str = "edu_fineweb10B"
+    B: int = 16 # micro batch size
+    T: int = 1024
+    val_B: int = 64 # sequences per validation forward
+    total_batch_size: int = 524288 # tokens per optimizer step, grad_accum_steps is derived from it
+    packed: bool = False # mask attention across <|endoftext|> boundaries and restart positions per document
+    data_mixture: str = "" # "path:weight,..." train sources (shard dirs, .npy shards, text files) sampled per row, empty reads data_root in order
+    # model
+    block_size: int = 3048
+    vocab_size: int = 50304
+    n_layer: int = 12
+    n_head: int = 12
+    n_embd: int = 768
+    mask_buffer: bool = True
+    activation_checkpointing: int = 0 # 0 none, N every N-th block, 1 all blocks
+    memory_budget_gb: float = 0.0 # > 0 picks B and activation_checkpointing to fit this much memory per rank
+    loss_chunk: int = 0 # > 0 computes lm_head + cross entropy this many tokens at a time, never holding the full logits
+    # execution: eager, or torch.compile with a mode (default, reduce-overhead, max-autotune, ...)
+    compile: bool = False
+    compile_mode: str = "default"
+    compile_dynamic: str = "auto" # auto, true or false
+    # optimization
+    max_lr: float = 6e-4*3
+    min_lr_ratio: float = 0.1
+    warmup_steps: int = 100
+    max_steps: int = 19073*2
+    weight_decay: float = 0.1
+    grad_clip: float = 1.0
+    zero: bool = False # shard the AdamW state across DDP ranks (ZeRO-1)
+    seed: int = 1337
+    # evaluation, logging and checkpoints, an interval of 0 disables it
+    val_interval: int = 100
+    val_tokens: int = 10485760 # size of the fixed val set, split across ranks
+    hella_interval: int = 250
+    sample_interval: int = 100
+    checkpoint_interval: int = 5000
+    checkpoint_keep: int = 0 # keep only the newest N checkpoints, 0 keeps all
+    checkpoint_async: bool = True # write checkpoints from a background thread
+    checkpoint_sharded: bool = False # every rank writes its own part into a model_<step>/ directory
+    log_dir: str = "log"
+    metrics_file: str = "metrics.jsonl" # per-step profile inside log_dir, .csv for csv, empty to disable
+    peak_flops: float = 0.0 # per device peak for MFU, 0 picks a default for the device
+    trace_start: int = -1 # first step of a torch.profiler trace written to log_dir
+    trace_steps: int = 0
+    # hardware, "auto" picks cuda > mps > cpu, bfloat16 autocast where it is supported and nccl/gloo to match
+    device: str = "auto"
+    dtype: str = "auto"
+    backend: str = "auto"
+
+def parse_config(argv=None):
+    # defaults < --config json file < command line flags
+    parser = argparse.ArgumentParser(description="train GPT")
+    parser.add_argument("--config", type=str, default=None, help="json file with TrainConfig fields")
+    for f in fields(TrainConfig):
+        if f.type is bool:
+            parser.add_argument(f"--{f.name}", type=lambda v: v.lower() in ("1", "true", "yes"), default=None)
+        else:
+            parser.add_argument(f"--{f.name}", type=f.type, default=None)
+    args = parser.parse_args(argv)
+    values = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            values.update(json.load(f))
+    values.update({k: v for k, v in vars(args).items() if k != "config" and v is not None})
+    return TrainConfig(**values)
+
+def autodetect_device():
+    if torch.cuda.is_available():
+        return "cuda"
+    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def autodetect_dtype(device_type):
+    if device_type == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    # bfloat16 autocast on cpu is slower than fp32 unless the cpu has native bf16 matmuls
+    return torch.float32
+
+def compile_model(model, mode="default", dynamic=None):
+    # torch.compile fuses the MLP, LayerNorm and residual elementwise ops around the matmuls.
+    # the compiled wrapper shares parameters with model, so keep saving model.state_dict()
+    kwargs = {} if mode == "default" else {"mode": mode}
+    return torch.compile(model, dynamic=dynamic, **kwargs)
+
+def optimizer_state_bytes(optimizer):
+    # the AdamW state this rank holds, for ZeRO only the local partition
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer = optimizer.optim
+    return sum(v.numel() * v.element_size() for state in optimizer.state.values() for v in state.values() if torch.is_tensor(v))
+
+def synchronize(device_type):
+    if device_type == "cuda":
+        torch.cuda.synchronize()
+    elif device_type == "mps":
+        torch.mps.synchronize()
+
+class Trainer:
+    def __init__(self, config):
+        self.config = config
+        c = config
+        # set up DDP (distributed data parallel). torchrun sets the RANK, LOCAL_RANK and WORLD_SIZE env vars
+        self.ddp = int(os.environ.get("RANK", -1)) != -1
+        device = autodetect_device() if c.device == "auto" else c.device
+        self.device_type = device.split(":")[0]
+        if self.ddp:
+            backend = ("nccl" if self.device_type == "cuda" else "gloo") if c.backend == "auto" else c.backend
+            init_process_group(backend=backend)
+            self.ddp_rank = int(os.environ['RANK'])
+            self.ddp_local_rank = int(os.environ['LOCAL_RANK'])
+            self.ddp_world_size = int(os.environ['WORLD_SIZE'])
+            if self.device_type == "cuda":
+                device = f"cuda:{self.ddp_local_rank}"
+                torch.cuda.set_device(device)
+        else:
+            self.ddp_rank = 0
+            self.ddp_local_rank = 0
+            self.ddp_world_size = 1
+        self.device = device
+        self.master_process = self.ddp_rank == 0
+        self.dtype = autodetect_dtype(self.device_type) if c.dtype == "auto" else getattr(torch, c.dtype)
+        if self.master_process:
+            print(f"using device {self.device} with {self.dtype} compute, world size {self.ddp_world_size}")
+        torch.manual_seed(c.seed)
+
+        torch.set_float32_matmul_precision('high')
+        os.makedirs(c.log_dir, exist_ok=True)
+        self.log_file = os.path.join(c.log_dir, f"log.txt")
+        # resume from the newest checkpoint in log_dir, so a preempted job can simply be relaunched
+        resume_path = latest_checkpoint(c.log_dir)
+        resume = load_checkpoint(resume_path) if resume_path is not None else None
+        model_config = ModelConfig(block_size=c.block_size, vocab_size=c.vocab_size, n_layer=c.n_layer, n_head=c.n_head, n_embd=c.n_embd, mask_buffer=c.mask_buffer)
+        if resume is not None:
+            model_config = resume['config']
+            model_config.mask_buffer = c.mask_buffer # the buffer is dead weight, so it can be dropped on resume
+        model = GPT(model_config)
+        if resume is not None:
+            model.load_state_dict(resume['model'])
+        model.to(self.device)
+        self.raw_model = model # checkpoints, generation and the optimizer always use the plain module
+
+        if c.memory_budget_gb > 0:
+            if resume is not None and 'train_config' in resume:
+                # the loader cursors in the checkpoint only make sense with the micro batch they were written with
+                B, every = resume['train_config']['B'], resume['train_config']['activation_checkpointing']
+            else:
+                measure = None
+                if self.device_type == "cuda":
+                    measure = lambda B, every: measure_step_memory(model, B, c.T, every, self.device, None if self.dtype == torch.float32 else self.dtype, c.loss_chunk)
+                B, every, _ = plan_micro_batch(model_config, c.T, c.total_batch_size, self.ddp_world_size, c.memory_budget_gb * 2**30,
+                                               measure=measure, act_bytes=4 if self.dtype == torch.float32 else 2, loss_chunk=c.loss_chunk)
+            self.config = c = replace(c, B=B, activation_checkpointing=every)
+            if self.master_process:
+                print(f"memory budget {c.memory_budget_gb} GB: micro batch {c.B}, activation checkpointing every {c.activation_checkpointing}")
+        model.set_activation_checkpointing(c.activation_checkpointing)
+        assert c.total_batch_size % (c.B * c.T * self.ddp_world_size) == 0, "total_batch_size must be divisible by B * T * world size"
+        self.grad_accum_steps = c.total_batch_size // (c.B * c.T * self.ddp_world_size)
+        if self.master_process:
+            print(f"total desired batch size:{c.total_batch_size}")
+            print(f"grad_accum_steps:{self.grad_accum_steps}")
+        if c.data_mixture:
+            loader = MixtureLoader(B=c.B, T=c.T, process_rank=self.ddp_rank, num_processes=self.ddp_world_size, sources=parse_mixture(c.data_mixture), seed=c.seed, packed=c.packed)
+        else:
+            loader = DataLoaderLite(B=c.B, T=c.T, process_rank=self.ddp_rank, num_processes=self.ddp_world_size, split="train", data_root=c.data_root, packed=c.packed)
+        self.train_loader = PrefetchLoader(loader, device=self.device)
+        self.val_set = ValidationSet(c.T, c.val_tokens, self.ddp_rank, self.ddp_world_size, data_root=c.data_root, device=self.device)
+
+        if c.compile:
+            model = compile_model(model, c.compile_mode, {"auto": None, "true": True, "false": False}[c.compile_dynamic])
+        # evals run outside DDP: ranks do different numbers of forwards there and DDP's forward can be a collective
+        self.eval_model = model
+        if self.ddp:
+            model = DDP(model, device_ids=[self.ddp_local_rank] if self.device_type == "cuda" else None)
+        self.model = model
+        self.optimizer = self.raw_model.configure_optimizers(weight_decay=c.weight_decay, learning_rate=c.max_lr, device=self.device, zero=c.zero and self.ddp)
+        self.start_step = 0
+        if resume is not None:
+            self.optimizer.load_state_dict(resume['optimizer'])
+            if len(resume['loader']) == self.ddp_world_size:
+                self.train_loader.load_state_dict(resume['loader'][self.ddp_rank])
+            else:
+                self.train_loader.load_state_dict(self.train_loader.loader.rank_state(resume['loader'][0]))
+            set_rng_state(resume['rng'][self.ddp_rank % len(resume['rng'])])
+            self.start_step = resume['step']
+            if self.master_process:
+                print(f"resuming from {resume_path} at step {self.start_step}")
+            del resume
+        elif self.master_process:
+            with open(self.log_file, "w") as f: # open for writing to clear the file
+                pass
+        self.hella_datas = None
+        self.checkpoint_writer = CheckpointWriter(c.log_dir, keep=c.checkpoint_keep, background=c.checkpoint_async,
+                                                  prune=self.master_process, on_done=self.checkpoint_written)
+        self.profiler = StepProfiler(
+            path=os.path.join(c.log_dir, c.metrics_file) if c.metrics_file else None,
+            device_type=self.device_type, rank=self.ddp_rank, world_size=self.ddp_world_size,
+            flops_per_token=self.raw_model.flops_per_token(c.T),
+            peak_flops=c.peak_flops or default_peak_flops(self.device_type),
+            trace_dir=c.log_dir, trace_start=c.trace_start, trace_steps=c.trace_steps)
+
+    def autocast(self):
+        if self.dtype == torch.float32:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def log(self, line):
+        if self.master_process:
+            with open(self.log_file, "a") as f:
+                f.write(line + "\n")
+
+    def get_lr(self, it):
+        c = self.config
+        min_lr = c.max_lr * c.min_lr_ratio
+        if it < c.warmup_steps:
+            return c.max_lr*(it+1)/c.warmup_steps
+        if it > c.max_steps:
+            return min_lr
+        decay_ratio = (it - c.warmup_steps) / (c.max_steps - c.warmup_steps)
+        coeff = 0.5*(1.0+math.cos(math.pi*decay_ratio))
+        return min_lr + coeff*(c.max_lr - min_lr)
+
+    def evaluate_val(self, step):
+        model = self.eval_model
         model.eval()
-        val_loader.reset()
-        with torch.no_grad():
-            val_loss_accum = 0.0
-            val_loss_steps = 20
-            for _ in range(val_loss_steps):
-                x, y = val_loader.next_batch()
-                x,y = x.to("cuda"), y.to("cuda")
-                with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-                    logits, loss = model(x,y)
-                loss = loss/val_loss_steps
-                val_loss_accum += loss.detach()
-        if ddp:
-            dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
-        if master_process:
-            print(f"validation loss: {val_loss_accum.item():.4f}")
-            with open(log_file, "a") as f:
-                f.write(f"{step} val {val_loss_accum.item():.4f}\n")
-            if step > 0 and (step %5000 == 0 or last_step):
-                checkpoint_path = os.path.join(log_dir,f"model_{step:05d}.pt")
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'config': raw_model.config,
-                    'step':step,
-                    'val_loss': val_loss_accum.item()
-                }
-                print(checkpoint_path)
-                torch.save(checkpoint,checkpoint_path)
-    if (step%250 == 0 or last_step):
-        num_correct_norm = 0
-        num_total = 0
-        
-        for i, example in enumerate(iterate_examples("val")):
-            if i % ddp_world_size != ddp_rank:
-                continue 
-        _, tokens, mask, label = render_example(example)
-        tokens = tokens.to("cuda")
-        mask = mask.to("cuda")
-        with torch.no_grad():
-            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-                logits, loss = model(tokens)
-            pred_norm = get_most_likely_row(tokens,mask, logits)
-        num_total += 1
-        num_correct_norm += int(pred_norm == label)
-        if ddp:
-            num_total = torch.tensor(num_total,dtype=torch.long,device="cuda")
-            num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device="cuda")
+        loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        num_tokens = torch.zeros((), dtype=torch.float64, device=self.device)
+        with torch.inference_mode():
+            for x, y in self.val_set.batches(self.config.val_B):
+                with self.autocast():
+                    logits, loss = model(x,y, loss_chunk=self.config.loss_chunk)
+                loss_sum += loss.double() * y.numel()
+                num_tokens += y.numel()
+        if self.ddp:
+            dist.all_reduce(loss_sum, op=dist.ReduceOp.SUM)
+            dist.all_reduce(num_tokens, op=dist.ReduceOp.SUM)
+        val_loss = (loss_sum / num_tokens).item()
+        if self.master_process:
+            print(f"validation loss: {val_loss:.4f}")
+        self.log(f"{step} val {val_loss:.4f}")
+        return val_loss
+
+    def report_mixture(self, step):
+        # realized source ratios and epochs of the batches consumed so far, the same on every rank
+        loader = self.train_loader.loader
+        state = self.train_loader.state_dict()
+        if self.master_process:
+            print(f"mixture: {loader.describe(state)}")
+        self.log(f"{step} mixture " + " ".join(f"{r:.4f}" for r in loader.ratios(state)))
+
+    def evaluate_hellaswag(self, step):
+        if self.hella_datas is None:
+            # this rank's share of the pre-tokenized HellaSwag val examples, memory-mapped from the disk cache
+            if self.master_process:
+                CachedExamples("val") # builds the cache if it is missing or stale
+            if self.ddp:
+                dist.barrier()
+            hella_examples = CachedExamples("val")
+            self.hella_datas = [hella_examples[i] for i in range(self.ddp_rank, len(hella_examples), self.ddp_world_size)]
+        model = self.eval_model
+        model.eval()
+        autocast_dtype = None if self.dtype == torch.float32 else self.dtype
+        if self.config.loss_chunk:
+            loss_fn = lambda tokens: model(tokens[:, :-1], tokens[:, 1:], loss_chunk=self.config.loss_chunk, reduction="none")[1]
+            result = evaluate_batched(None, self.hella_datas, self.device, autocast_dtype=autocast_dtype, loss_fn=loss_fn)
+        else:
+            result = evaluate_batched(lambda tokens: model(tokens)[0], self.hella_datas, self.device, autocast_dtype=autocast_dtype)
+        num_total = result["num_total"]
+        num_correct_norm = result["num_correct_norm"]
+        if self.ddp:
+            num_total = torch.tensor(num_total,dtype=torch.long,device=self.device)
+            num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=self.device)
             dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
             dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
             num_total = num_total.item()
             num_correct_norm = num_correct_norm.item()
         acc_norm = num_correct_norm /num_total
-        if master_process:
-            print(f"Hellaswag accuracy {num_correct_norm}/{num_total}={acc_norm}" )
-            with open(log_file,"a") as f:
-                f.write(f"{step} hella {acc_norm}\n")
-    if step > 0 and step %100 == 0:
-        model.eval()
-        num_return_sequences = 4
-        max_length = 32
+        if self.master_process:
+            print(f"Hellaswag accuracy {num_correct_norm}/{num_total}={acc_norm} | {result['examples_per_sec']:.1f} examples/sec per rank" )
+        self.log(f"{step} hella {acc_norm}")
+        return acc_norm
+
+    def sample(self, num_return_sequences=4, max_length=32, prompt="Hello I am a langauge model"):
+        self.model.eval()
         enc = tiktoken.get_encoding("gpt2")
-        tokens = enc.encode("Hello I am a langauge model")
+        tokens = enc.encode(prompt)
         tokens = torch.tensor(tokens, dtype=torch.long)
         tokens = tokens.unsqueeze(0).repeat(num_return_sequences,1)
-        xgen = tokens.to("cuda")
-        sample_rng = torch.Generator(device="cuda")
-        sample_rng.manual_seed(42+ddp_rank)
-        while xgen.size(1) < max_length:
-            with torch.no_grad():
-                with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-                    logits, loss = model(xgen)
-                logits = logits[:,-1,:]
-                probs = F.softmax(logits, dim=-1)
-                topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                ix = torch.multinomial(topk_probs, 1,generator=sample_rng)
-                xcol = torch.gather(topk_indices, -1, ix)
-                xgen = torch.cat((xgen,xcol),dim=1)
+        xgen = tokens.to(self.device)
+        sample_rng = torch.Generator(device=self.device)
+        sample_rng.manual_seed(42+self.ddp_rank)
+        with self.autocast():
+            xgen = self.raw_model.generate(xgen, max_length - xgen.size(1), top_k=50, generator=sample_rng)
         for i in range(num_return_sequences):
             tokens= xgen[i,:max_length].tolist()
             decoded = enc.decode(tokens)
-            print(f"rank{ddp_rank} sample {i}: {decoded}")
-
-
-    model.train()
-    optimizer.zero_grad()
-    loss_accum = 0.0
-    for micro_step in range(grad_accum_steps):
-        x,y = train_loader.next_batch()
-        x = x.to("cuda")
-        y = y.to("cuda")
-        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-            logits, loss = model(x,y)
-        loss = loss / grad_accum_steps
-        loss_accum += loss.detach()
-        if ddp:
-            model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1)
-        loss.backward()
-    if ddp:
-        dist.all_reduce(loss_accum,op=dist.ReduceOp.AVG)
-    norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-    lr = get_lr(step)
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-    optimizer.step()
-    torch.cuda.synchronize()
-    t1 = time.time()
-    dt = t1-t0
-    tokens_processed = train_loader.B * train_loader.T * grad_accum_steps*ddp_world_size
-    tokens_per_sec = tokens_processed / (t1-t0)
-    if master_process:
-        print(f"step {step:4d} | loss {loss_accum.item():.6f} | lr {lr:.6f} | norm: {norm:.4f} | dt: {dt*1000} tokens/sec {tokens_per_sec:.0f}")
-        with open(log_file, "a") as f:
-            f.write(f"{step} train {loss_accum.item()}\n")
-
-if ddp:
-    destroy_process_group()
+            print(f"rank{self.ddp_rank} sample {i}: {decoded}")
+
+    def save_checkpoint(self, step, val_loss):
+        c = self.config
+        meta = {'config': self.raw_model.config, 'step': step, 'val_loss': val_loss, 'train_config': asdict(c)}
+        if c.checkpoint_sharded:
+            # every rank writes its slice of the model and optimizer state and its own cursors, no collectives needed
+            rank, world_size = self.ddp_rank, self.ddp_world_size
+            checkpoint = {
+                'step': step,
+                'rank': rank,
+                'world_size': world_size,
+                'meta': meta if rank == 0 else None,
+                'model': {k: v for i, (k, v) in enumerate(self.raw_model.state_dict().items()) if i % world_size == rank},
+                'optimizer': optimizer_shard(self.optimizer, rank, world_size),
+                'loader': self.train_loader.state_dict(),
+                'rng': get_rng_state(),
+            }
+            checkpoint_path = shard_filename(os.path.join(c.log_dir, f"model_{step:05d}"), rank)
+        else:
+            # every rank contributes its loader cursor and rng state, rank 0 writes the file
+            loader_states = [self.train_loader.state_dict()]
+            rng_states = [get_rng_state()]
+            if self.ddp:
+                loader_states = [None] * self.ddp_world_size
+                rng_states = [None] * self.ddp_world_size
+                dist.all_gather_object(loader_states, self.train_loader.state_dict())
+                dist.all_gather_object(rng_states, get_rng_state())
+            if isinstance(self.optimizer, ZeroRedundancyOptimizer):
+                # collective, gathers the full AdamW state on rank 0 so the checkpoint loads at any world size, sharded or not
+                self.optimizer.consolidate_state_dict(to=0)
+            if not self.master_process:
+                return
+            checkpoint = {
+                'model': self.raw_model.state_dict(),
+                **meta,
+                'optimizer': self.optimizer.state_dict(),
+                'loader': loader_states,
+                'rng': rng_states,
+            }
+            checkpoint_path = os.path.join(c.log_dir,f"model_{step:05d}.pt")
+        # only the copy to cpu happens here, the write itself overlaps with the following steps
+        blocked = self.checkpoint_writer.save(checkpoint, checkpoint_path)
+        if self.master_process:
+            print(f"{checkpoint_path}: step loop blocked {1000*blocked:.1f}ms")
+        self.log(f"{step} checkpoint_blocked {blocked:.4f}")
+
+    def checkpoint_written(self, checkpoint, path, seconds):
+        # runs on the writer thread
+        if self.master_process:
+            print(f"{path}: written in {1000*seconds:.1f}ms")
+        self.log(f"{checkpoint['step']} checkpoint_write {seconds:.4f}")
+
+    def train_step(self, step):
+        model, optimizer, train_loader, prof = self.model, self.optimizer, self.train_loader, self.profiler
+        model.train()
+        stall_start = train_loader.stall_time
+        optimizer.zero_grad()
+        loss_accum = torch.zeros((), device=self.device)
+        for micro_step in range(self.grad_accum_steps):
+            last_micro_step = micro_step == self.grad_accum_steps - 1
+            with prof.phase("data"):
+                x, y, *packing = train_loader.next_batch()
+            packing = dict(zip(("doc_ids", "pos"), packing))
+            if self.ddp:
+                # DDP reads this in forward to decide whether the following backward all-reduces
+                model.require_backward_grad_sync = last_micro_step
+            with prof.phase("forward"):
+                with self.autocast():
+                    logits, loss = model(x,y, loss_chunk=self.config.loss_chunk, **packing)
+                loss = loss / self.grad_accum_steps
+                loss_accum += loss.detach()
+            with prof.phase("backward_sync" if self.ddp and last_micro_step else "backward"):
+                loss.backward()
+        if self.ddp:
+            with prof.phase("allreduce"):
+                dist.all_reduce(loss_accum,op=dist.ReduceOp.AVG)
+        with prof.phase("optimizer"):
+            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.config.grad_clip)
+            lr = self.get_lr(step)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+            optimizer.step()
+        synchronize(self.device_type)
+        if step == self.start_step:
+            print(f"rank{self.ddp_rank} optimizer state: {optimizer_state_bytes(optimizer)/2**20:.2f} MB")
+        tokens_processed = train_loader.B * train_loader.T * self.grad_accum_steps*self.ddp_world_size
+        record = prof.end_step(tokens_processed)
+        if self.master_process:
+            data_stall = train_loader.stall_time - stall_start
+            mfu = f" | mfu {100*record['mfu']:.1f}%" if record['mfu'] is not None else ""
+            print(f"step {step:4d} | loss {loss_accum.item():.6f} | lr {lr:.6f} | norm: {norm:.4f} | dt: {record['train_ms']:.1f}ms tokens/sec {record['tokens_per_sec']:.0f}{mfu} | data stall: {data_stall*1000:.2f}ms queue: {train_loader.queue_depth()}")
+        self.log(f"{step} train {loss_accum.item()}")
+        return loss_accum.item()
+
+    def train(self):
+        c = self.config
+        prof = self.profiler
+        for step in range(self.start_step, c.max_steps):
+            last_step = (step == c.max_steps - 1)
+            prof.begin_step(step)
+            with prof.phase("eval"):
+                if c.val_interval > 0 and step % c.val_interval == 0:
+                    val_loss = self.evaluate_val(step)
+                    if c.data_mixture:
+                        self.report_mixture(step)
+                    if c.checkpoint_interval > 0 and step > self.start_step and (step % c.checkpoint_interval == 0 or last_step):
+                        self.save_checkpoint(step, val_loss)
+                if c.hella_interval > 0 and (step % c.hella_interval == 0 or last_step):
+                    self.evaluate_hellaswag(step)
+                if c.sample_interval > 0 and step > 0 and step % c.sample_interval == 0:
+                    self.sample()
+            self.train_step(step)
+
+    def close(self):
+        self.checkpoint_writer.close()
+        self.profiler.close()
+        self.train_loader.close()
+        if self.ddp:
+            destroy_process_group()
 
+if __name__ == "__main__":
+    # python gpttrainer.py --config config.json --max_steps 100
+    # torchrun --standalone --nproc_per_node=8 gpttrainer.py
+    # torchrun --standalone --nproc_per_node=2 gpttrainer.py --device cpu (gloo)
+    trainer = Trainer(parse_config())
+    trainer.train()
+    trainer.close()
@@ -1,12 +1,16 @@
 import os
 import json
+import time
+import contextlib
+import hashlib
+import shutil
 import requests
+import numpy as np
 import tiktoken
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import GPT2LMHeadModel
 
 # -----------------------------------------------------------------------------
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
@@ -90,8 +94,200 @@ def iterate_examples(split):
             example = json.loads(line)
             yield example
 
+# -----------------------------------------------------------------------------
+# pre-tokenized cache: each split is tokenized once into flat uint16 arrays that later
+# passes memory-map, instead of re-parsing the jsonl and re-running enc.encode every time
+
+CACHE_VERSION = 1
+
+def cache_dir(split):
+    return os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}_cache")
+
+def cache_meta(split):
+    # everything the cached tokens depend on; any change invalidates the cache
+    download(split)
+    sha = hashlib.sha256()
+    with open(os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}.jsonl"), "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return {"version": CACHE_VERSION, "source_sha256": sha.hexdigest(), "tokenizer": enc.name, "n_vocab": enc.n_vocab}
+
+def build_cache(split):
+    """
+    Tokenizes a split into cache_dir(split):
+    - tokens.npy: uint16, per example the context followed by its 4 endings
+    - offsets.npy: int64 (N, 6), start of the context, start of each ending, end of the example
+    - labels.npy: int64 (N,)
+    - meta.json: source hash and tokenizer, checked on load
+    The ending offsets are the completion-start index of each candidate row.
+    """
+    meta = cache_meta(split)
+    tokens, offsets, labels = [], [], []
+    pos = 0
+    for example in iterate_examples(split):
+        data, _, _, label = render_example(example)
+        parts = [data["ctx_tokens"]] + data["ending_tokens"]
+        row = [pos]
+        for part in parts:
+            tokens.extend(part)
+            pos += len(part)
+            row.append(pos)
+        offsets.append(row)
+        labels.append(label)
+    assert enc.n_vocab < 2**16, "token dictionary too large for uint16"
+    # write under a temp name and rename into place, so concurrent ranks never see a half written cache
+    final_dir = cache_dir(split)
+    tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, "tokens.npy"), np.array(tokens, dtype=np.uint16))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "labels.npy"), np.array(labels, dtype=np.int64))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, final_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True) # another process won the race, its cache is identical
+    return final_dir
+
+class CachedExamples:
+    """
+    Memory-mapped view of a pre-tokenized split. Indexing returns the same data dict
+    as render_example (ctx_tokens, ending_tokens, label), with uint16 array slices as tokens.
+    """
+    def __init__(self, split):
+        path = cache_dir(split)
+        meta = None
+        if os.path.exists(os.path.join(path, "meta.json")):
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        if meta != cache_meta(split):
+            print(f"building HellaSwag {split} token cache in {path}...")
+            build_cache(split)
+        self.tokens = np.load(os.path.join(path, "tokens.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.labels = np.load(os.path.join(path, "labels.npy"))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, i):
+        o = self.offsets[i]
+        return {
+            "label": int(self.labels[i]),
+            "ctx_tokens": self.tokens[o[0]:o[1]],
+            "ending_tokens": [self.tokens[o[j]:o[j+1]] for j in range(1, 5)],
+        }
+
+def iterate_rendered(split):
+    # drop-in for `render_example(example) for example in iterate_examples(split)`, read from the cache
+    examples = CachedExamples(split)
+    for i in range(len(examples)):
+        data = examples[i]
+        tokens, mask = collate_examples([data])
+        yield data, tokens, mask, data["label"]
+
+def score_rows(tokens, mask, logits):
+    """
+    Per-row completion losses for a batch of padded rows, the same computation as
+    evaluate() and get_most_likely_row but vectorized over any number of rows.
+    Returns (sum_loss, avg_loss), each of shape (rows,).
+    Only the completion positions go through cross entropy, gathered straight out of the logits,
+    the context and padding positions (most of a padded batch) are never copied or scored.
+    """
+    shift_mask = mask[..., 1:].bool()
+    shift_losses = torch.zeros(shift_mask.shape, dtype=torch.float32, device=logits.device)
+    shift_losses[shift_mask] = F.cross_entropy(logits[..., :-1, :][shift_mask], tokens[..., 1:][shift_mask], reduction='none').float()
+    return score_losses(shift_losses, mask)
+
+def score_losses(shift_losses, mask):
+    # score_rows from the (rows, T-1) next-token losses
+    shift_mask = (mask[..., 1:]).contiguous() # padding has mask 0, so it never contributes
+    masked_shift_losses = shift_losses * shift_mask
+    sum_loss = masked_shift_losses.sum(dim=1)
+    avg_loss = sum_loss / shift_mask.sum(dim=1)
+    return sum_loss, avg_loss
+
+def collate_examples(datas):
+    """
+    Packs the 4 candidate rows of each rendered example (the data dict returned by
+    render_example) into one right-padded batch of shape (4*len(datas), max_len).
+    The model is causal, so padding to the right never changes the logits of real tokens.
+    """
+    rows = [(data["ctx_tokens"], end) for data in datas for end in data["ending_tokens"]]
+    max_len = max(len(ctx) + len(end) for ctx, end in rows)
+    tokens = np.zeros((len(rows), max_len), dtype=np.int64)
+    mask = np.zeros((len(rows), max_len), dtype=np.int64)
+    # token lists from render_example and uint16 slices from the disk cache both work here
+    for i, (ctx, end) in enumerate(rows):
+        tokens[i, :len(ctx)] = ctx
+        tokens[i, len(ctx):len(ctx) + len(end)] = end
+        mask[i, len(ctx):len(ctx) + len(end)] = 1
+    return torch.from_numpy(tokens), torch.from_numpy(mask)
+
+def iterate_batches(datas, max_tokens):
+    """
+    Yields (indices, batch datas) with examples sorted by length, so each batch holds
+    similar lengths and at most max_tokens padded tokens (always at least one example)
+    """
+    def example_len(i):
+        return len(datas[i]["ctx_tokens"]) + max(len(end) for end in datas[i]["ending_tokens"])
+    order = sorted(range(len(datas)), key=example_len)
+    batch = []
+    for i in order:
+        # sorted ascending, so example i sets the padded length of the batch
+        if batch and (len(batch) + 1) * 4 * example_len(i) > max_tokens:
+            yield batch, [datas[j] for j in batch]
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch, [datas[j] for j in batch]
+
+@torch.no_grad()
+def evaluate_batched(model_fn, datas, device, max_tokens=None, autocast_dtype=None, loss_fn=None):
+    """
+    Scores rendered examples in large length-sorted padded batches.
+    model_fn maps a (rows, T) token tensor to (rows, T, vocab) logits, or loss_fn, when given,
+    maps it straight to the (rows, T-1) next-token losses, without the full logits.
+    Returns a dict with the counts, per-example predictions and examples/sec.
+    max_tokens defaults to 8192 padded tokens per forward on cuda and 512 on cpu, where the
+    (rows, T, vocab) logits dominate and larger batches only add memory traffic.
+    """
+    device_type = "cuda" if "cuda" in str(device) else "cpu"
+    max_tokens = max_tokens or (8192 if device_type == "cuda" else 512)
+    preds = [None] * len(datas)
+    preds_norm = [None] * len(datas)
+    t0 = time.time()
+    for indices, batch in iterate_batches(datas, max_tokens):
+        tokens, mask = collate_examples(batch)
+        tokens, mask = tokens.to(device), mask.to(device)
+        autocast = torch.autocast(device_type=device_type, dtype=autocast_dtype) if autocast_dtype is not None else contextlib.nullcontext()
+        with autocast:
+            if loss_fn is not None:
+                sum_loss, avg_loss = score_losses(loss_fn(tokens).float(), mask)
+            else:
+                sum_loss, avg_loss = score_rows(tokens, mask, model_fn(tokens))
+        pred = sum_loss.view(-1, 4).argmin(dim=1).tolist()
+        pred_norm = avg_loss.view(-1, 4).argmin(dim=1).tolist()
+        for j, i in enumerate(indices):
+            preds[i] = pred[j]
+            preds_norm[i] = pred_norm[j]
+    dt = time.time() - t0
+    labels = [data["label"] for data in datas]
+    return {
+        "num_total": len(datas),
+        "num_correct": sum(int(p == l) for p, l in zip(preds, labels)),
+        "num_correct_norm": sum(int(p == l) for p, l in zip(preds_norm, labels)),
+        "preds": preds,
+        "preds_norm": preds_norm,
+        "examples_per_sec": len(datas) / dt if dt > 0 else float("inf"),
+    }
+
 @torch.no_grad()
 def evaluate(model_type, device):
+    from transformers import GPT2LMHeadModel
 
     torch.set_float32_matmul_precision('high') # use tf32
     model = GPT2LMHeadModel.from_pretrained(model_type)
@@ -141,10 +337,29 @@ def evaluate(model_type, device):
                 print(f"{i} (loss: {avg_loss[i].item():.4f}) {end}")
             print(f"predicted: {pred_norm}, actual: {label}")
 
+@torch.no_grad()
+def evaluate_fast(model_type, device, max_tokens):
+    from transformers import GPT2LMHeadModel
+
+    torch.set_float32_matmul_precision('high') # use tf32
+    model = GPT2LMHeadModel.from_pretrained(model_type)
+    model.to(device)
+    examples = CachedExamples("val")
+    datas = [examples[i] for i in range(len(examples))]
+    result = evaluate_batched(lambda tokens: model(tokens).logits, datas, device, max_tokens=max_tokens)
+    num_total, num_correct_norm = result["num_total"], result["num_correct_norm"]
+    print(f"acc: {result['num_correct']}/{num_total}={result['num_correct']/num_total:.4f}")
+    print(f"acc_norm: {num_correct_norm}/{num_total}={num_correct_norm/num_total:.4f}")
+    print(f"{result['examples_per_sec']:.1f} examples/sec")
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="the model type to use")
     parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+    parser.add_argument("-b", "--batch_tokens", type=int, default=0, help="if > 0, use the batched engine with this many padded tokens per forward")
     args = parser.parse_args()
-    evaluate(args.model_type, args.device)
\ No newline at end of file
+    if args.batch_tokens > 0:
+        evaluate_fast(args.model_type, args.device, args.batch_tokens)
+    else:
+        evaluate(args.model_type, args.device)
\ No newline at end of file
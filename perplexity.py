@@ -0,0 +1,119 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+from gpttrainer import load_tokens, window_to_tensor
+from serve import load_model
+
+# -----------------------------------------------------------------------------
+# sliding window perplexity of a trainer checkpoint or a gpt2 variant over .npy token shards
+# (memory-mapped) and text files, with batched windows and optional torchrun data parallelism
+# usage: python perplexity.py --model log --files edu_fineweb10B/edufineweb_val_000000.npy --T 1024 --stride 512
+#        python perplexity.py --model gpt2 --files input.txt --stride 256 -b 8
+#        torchrun --standalone --nproc_per_node=8 perplexity.py --model log --files edu_fineweb10B/edufineweb_val_000000.npy
+
+def file_tokens(path):
+    # .npy shards are memory-mapped, anything else is read as text and tokenized
+    if path.endswith(".npy"):
+        return load_tokens(path)
+    import tiktoken
+    with open(path) as f:
+        return np.array(tiktoken.get_encoding("gpt2").encode_ordinary(f.read()), dtype=np.uint16)
+
+def iterate_windows(num_tokens, T, stride):
+    """
+    Yields (start, end, num_scored) sliding windows over num_tokens tokens: the window feeds
+    tokens[start:end] to predict tokens[start+1:end+1], and scores only its last num_scored
+    targets, the ones the previous window did not score. The first window scores all of them,
+    every later one sees at least T - stride tokens of context.
+    """
+    assert 0 < stride <= T, "stride must be in (0, T]"
+    n = num_tokens - 1 # number of targets
+    start, scored = 0, 0
+    while scored < n:
+        end = min(start + T, n)
+        yield start, end, end - scored
+        scored = end
+        start += stride
+
+@torch.no_grad()
+def score_windows(model, batch, device, autocast_dtype=None, loss_chunk=0):
+    # batch is a list of (tokens, num_scored) of equal length, returns the summed loss in float64
+    buf = torch.stack([window_to_tensor(tokens) for tokens, _ in batch]).to(device)
+    x, y = buf[:, :-1], buf[:, 1:]
+    with torch.autocast(device_type=torch.device(device).type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+        if loss_chunk:
+            _, losses = model(x, y, loss_chunk=loss_chunk, reduction="none")
+        else:
+            logits, _ = model(x)
+            losses = F.cross_entropy(logits.float().view(-1, logits.size(-1)), y.reshape(-1), reduction='none').view(y.shape)
+    return sum(losses[i, -num_scored:].double().sum() for i, (_, num_scored) in enumerate(batch))
+
+def evaluate(model, paths, T, stride, batch_size, device, autocast_dtype=None, rank=0, world_size=1, loss_chunk=0):
+    """Returns (summed loss, number of scored tokens, number of forwarded tokens) of this rank,
+    windows are dealt round-robin over the ranks"""
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    num_scored, num_forwarded, i = 0, 0, 0
+    for path in paths:
+        tokens = file_tokens(path)
+        batches = {} # windows grouped by length, only the last window of a file can be shorter
+        for start, end, scored in iterate_windows(len(tokens), T, stride):
+            if i % world_size == rank:
+                batch = batches.setdefault(end - start, [])
+                batch.append((tokens[start:end+1], scored))
+                num_scored += scored
+                num_forwarded += end - start
+                if len(batch) == batch_size:
+                    loss_sum += score_windows(model, batch, device, autocast_dtype, loss_chunk)
+                    batch.clear()
+            i += 1
+        for batch in batches.values():
+            if batch:
+                loss_sum += score_windows(model, batch, device, autocast_dtype, loss_chunk)
+    return loss_sum, num_scored, num_forwarded
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, required=True, help="checkpoint file or directory, log_dir, or gpt2 variant name")
+    parser.add_argument("-f", "--files", type=str, nargs="+", required=True, help=".npy token shards or text files")
+    parser.add_argument("-T", "--T", type=int, default=1024, help="window length")
+    parser.add_argument("-s", "--stride", type=int, default=512, help="window step, every scored token sees at least T - stride tokens of context")
+    parser.add_argument("-b", "--batch_size", type=int, default=4, help="windows per forward")
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--int8", action="store_true", help="weight-only int8 quantized linears")
+    parser.add_argument("--loss_chunk", type=int, default=0, help="> 0 scores this many tokens per lm_head chunk instead of materializing all logits")
+    args = parser.parse_args()
+
+    # torchrun splits the windows over processes
+    rank, world_size, device = 0, 1, args.device
+    if int(os.environ.get('RANK', -1)) != -1:
+        rank, world_size = int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+        if device.startswith("cuda"):
+            device = f"cuda:{int(os.environ['LOCAL_RANK'])}"
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend="nccl" if device.startswith("cuda") else "gloo")
+    model = load_model(args.model, device)
+    if args.int8:
+        from quantize import quantize_model
+        model = quantize_model(model)
+    assert args.T <= model.config.block_size, f"T must be at most block_size {model.config.block_size}"
+    autocast_dtype = torch.bfloat16 if args.dtype == "bfloat16" else None
+
+    t0 = time.time()
+    loss_sum, num_scored, num_forwarded = evaluate(model, args.files, args.T, args.stride, args.batch_size, device, autocast_dtype, rank, world_size, args.loss_chunk)
+    if world_size > 1:
+        counts = torch.tensor([num_scored, num_forwarded], dtype=torch.float64, device=device)
+        dist.all_reduce(loss_sum)
+        dist.all_reduce(counts)
+        num_scored, num_forwarded = int(counts[0].item()), int(counts[1].item())
+    dt = time.time() - t0
+    if rank == 0:
+        loss = loss_sum.item() / num_scored
+        print(f"{num_scored:,} tokens scored | loss {loss:.6f} | perplexity {np.exp(loss):.4f} | "
+              f"{num_scored/dt:.0f} scored tokens/sec, {num_forwarded/dt:.0f} forwarded tokens/sec")
+    if world_size > 1:
+        dist.destroy_process_group()
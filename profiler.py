@@ -0,0 +1,132 @@
+import os
+import csv
+import json
+import time
+import resource
+import contextlib
+import torch
+import torch.distributed as dist
+
+# -----------------------------------------------------------------------------
+# per-step phase timings, MFU, peak memory and cross-rank skew, written as jsonl or csv,
+# with optional torch.profiler trace capture for a window of steps
+
+PHASES = ["data", "forward", "backward", "backward_sync", "allreduce", "optimizer", "eval"]
+FIELDS = ["step", "dt_ms", "train_ms", "tokens", "tokens_per_sec", "mfu", "peak_mem_mb", "skew_ms", "slowest_rank"] + [f"{p}_ms" for p in PHASES]
+
+def default_peak_flops(device_type):
+    # bf16 dense peak of an A100, there is no meaningful default for other devices
+    return 312e12 if device_type == "cuda" else None
+
+class StepProfiler:
+    """
+    Times the phases of each training step. On cuda every phase is bracketed by cuda events
+    that are only resolved in end_step (after the step's synchronize), so profiling adds
+    no extra host-device syncs; on cpu the phases are timed with perf_counter.
+    backward_sync is the backward of the last micro step, which carries the DDP gradient all-reduce.
+    """
+    def __init__(self, path=None, device_type="cpu", rank=0, world_size=1, flops_per_token=None, peak_flops=None,
+                 trace_dir=None, trace_start=-1, trace_steps=0):
+        self.device_type = device_type
+        self.rank = rank
+        self.world_size = world_size
+        self.flops_per_token = flops_per_token
+        self.peak_flops = peak_flops
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace = None
+        self.file = None
+        self.writer = None
+        if path is not None and rank == 0:
+            exists = os.path.exists(path) and os.path.getsize(path) > 0
+            self.file = open(path, "a", newline="")
+            if path.endswith(".csv"):
+                self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+                if not exists:
+                    self.writer.writeheader()
+
+    def begin_step(self, step):
+        self.step = step
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.events = []
+        if self.device_type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        if self.trace_steps > 0 and step == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device_type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+        self.t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        label = torch.profiler.record_function(name) if self.trace is not None else contextlib.nullcontext()
+        with label:
+            if self.device_type == "cuda":
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self.events.append((name, start, end))
+            else:
+                t = time.perf_counter()
+                yield
+                self.times[name] += time.perf_counter() - t
+
+    def end_step(self, tokens):
+        # call after the step has been synchronized, tokens is the global number of tokens trained on
+        dt = time.perf_counter() - self.t0
+        for name, start, end in self.events:
+            self.times[name] += start.elapsed_time(end) / 1000
+        train_dt = dt - self.times["eval"]
+        record = {
+            "step": self.step,
+            "dt_ms": 1000*dt,
+            "train_ms": 1000*train_dt,
+            "tokens": tokens,
+            "tokens_per_sec": tokens / train_dt,
+            "mfu": None,
+            "peak_mem_mb": self.peak_memory_mb(),
+            "skew_ms": 0.0,
+            "slowest_rank": 0,
+        }
+        if self.flops_per_token is not None and self.peak_flops:
+            record["mfu"] = self.flops_per_token * tokens / self.world_size / train_dt / self.peak_flops
+        if self.world_size > 1:
+            # one small all_gather per step to see how far the slowest rank lags behind
+            device = "cuda" if self.device_type == "cuda" else "cpu"
+            mine = torch.tensor([train_dt], dtype=torch.float64, device=device)
+            all_dt = [torch.zeros_like(mine) for _ in range(self.world_size)]
+            dist.all_gather(all_dt, mine)
+            all_dt = [t.item() for t in all_dt]
+            record["skew_ms"] = 1000*(max(all_dt) - min(all_dt))
+            record["slowest_rank"] = all_dt.index(max(all_dt))
+        for name in PHASES:
+            record[f"{name}_ms"] = 1000*self.times[name]
+        if self.trace is not None and self.step == self.trace_start + self.trace_steps - 1:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.trace.export_chrome_trace(os.path.join(self.trace_dir, f"trace_rank{self.rank}_step{self.trace_start}.json"))
+            self.trace = None
+        if self.file is not None:
+            if self.writer is not None:
+                self.writer.writerow(record)
+            else:
+                self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        return record
+
+    def peak_memory_mb(self):
+        if self.device_type == "cuda":
+            return torch.cuda.max_memory_allocated() / 2**20
+        # process high-water mark, ru_maxrss is in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,67 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# -----------------------------------------------------------------------------
+# post-training weight-only int8 quantization of GPT: every nn.Linear weight is stored as int8
+# with one scale per output channel, activations and everything else stay in fp32/bf16
+
+def quantize_per_channel(weight):
+    # symmetric absmax quantization of each row, returns the int8 weight and the fp32 row scales
+    weight = weight.detach().float()
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    q = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+class Int8Linear(nn.Module):
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        q, scale = quantize_per_channel(linear.weight)
+        self.register_buffer("weight", q)
+        self.register_buffer("scale", scale)
+        self.bias = linear.bias
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        if x.device.type == "cpu" and x.size(0) <= 16:
+            # decode-sized inputs are bandwidth bound: fused kernel that reads the int8 weight directly
+            y = torch._weight_int8pack_mm(x.contiguous(), self.weight, self.scale.to(x.dtype))
+        else:
+            # large inputs are compute bound, dequantize once and use the regular matmul
+            y = F.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias.to(y.dtype)
+        return y.view(*shape[:-1], self.out_features)
+
+class Int8Embedding(nn.Module):
+    # token embedding tied to an Int8Linear lm_head: its per-output-channel scales are per-token scales
+    def __init__(self, linear):
+        super().__init__()
+        # a plain reference, not a submodule: the int8 weight exists once, lives in lm_head's
+        # state_dict and moves with lm_head on .to(), so the tie can't come apart
+        object.__setattr__(self, "tied", linear)
+
+    def forward(self, idx):
+        return self.tied.weight[idx].float() * self.tied.scale[idx].unsqueeze(-1)
+
+def quantize_model(model):
+    """
+    Replaces every nn.Linear of a GPT (c_attn, c_proj, c_fc, lm_head) with an Int8Linear in place,
+    for a trained checkpoint or from_pretrained weights alike. wte shares its weight with lm_head,
+    so it becomes an Int8Embedding reading the same int8 weight and scales.
+    """
+    assert model.transformer.wte.weight is model.lm_head.weight, "expects wte tied to lm_head"
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, name, Int8Linear(child))
+    model.transformer.wte = Int8Embedding(model.lm_head)
+    return model
+
+def model_bytes(model):
+    # parameters and buffers, tied tensors counted once
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import torch
+from gpttrainer import GPT, SlotKVCache
+from checkpoint import latest_checkpoint, shard_filename
+
+# -----------------------------------------------------------------------------
+# continuous batching inference for trainer checkpoints: requests join and leave the running
+# batch at every decode step, served over http or as json lines on stdin/stdout
+# usage: python serve.py --checkpoint log --port 8000
+#        curl -d '{"prompt": "Hello, I am", "max_tokens": 32, "temperature": 0.8, "top_k": 50}' localhost:8000
+#        echo '{"prompt": "Hello, I am", "max_tokens": 32}' | python serve.py --checkpoint log --stdin
+
+def load_model(path, device="cpu"):
+    # a model_*.pt file, a sharded model_*/ directory, a log_dir (its newest checkpoint) or a gpt2 variant name
+    if path.startswith("gpt2"):
+        return GPT.from_pretrained(path).to(device).eval()
+    if os.path.isdir(path) and not os.path.exists(shard_filename(path, 0)):
+        path = latest_checkpoint(path)
+        assert path is not None, "no checkpoint found"
+    return GPT.from_checkpoint(path, device).eval()
+
+class Request:
+    def __init__(self, tokens, max_tokens=64, temperature=1.0, top_k=None):
+        self.tokens = list(tokens) # prompt
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.output = []
+        self.slot = None
+        self.done = threading.Event()
+        self.arrival_time = time.time()
+        self.first_token_time = None
+        self.finish_time = None
+        self.error = None
+
+class Engine:
+    """
+    Iteration-level scheduler: every step first admits waiting requests into free cache slots
+    (prefilling the prompt and sampling the first token), then runs one batched decode step for
+    all running requests and retires the ones that reached their max_tokens, freeing their slot
+    for the next step. Each row samples with its own temperature and top_k.
+    """
+    def __init__(self, model, max_batch=16, max_len=None, device="cpu", seed=42):
+        self.model = model
+        self.device = device
+        self.max_len = min(max_len or model.config.block_size, model.config.block_size) # the position embeddings end at block_size
+        self.cache = SlotKVCache(model.config.n_layer, max_batch, self.max_len)
+        self.free_slots = list(range(max_batch))
+        self.active = []
+        self.waiting = queue.Queue()
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.num_steps = 0
+        self.num_rows = 0
+
+    def submit(self, tokens, max_tokens=64, temperature=1.0, top_k=None):
+        # requests arrive as json, so every field is checked for its type too: a float max_tokens would never
+        # be reached and a bad token id would fail the whole decode step inside the engine thread
+        is_int = lambda v: isinstance(v, int) and not isinstance(v, bool)
+        assert isinstance(tokens, list) and len(tokens) > 0, "empty prompt"
+        assert is_int(max_tokens) and max_tokens > 0, "max_tokens must be a positive integer"
+        assert len(tokens) + max_tokens <= self.max_len, f"prompt + max_tokens exceeds {self.max_len} tokens"
+        assert top_k is None or (is_int(top_k) and top_k >= 1), "top_k must be an integer of at least 1"
+        assert isinstance(temperature, (int, float)) and not isinstance(temperature, bool) and temperature >= 0, "temperature must be a non-negative number"
+        vocab_size = self.model.config.vocab_size
+        assert all(is_int(t) and 0 <= t < vocab_size for t in tokens), f"token ids must be integers in [0, {vocab_size})"
+        request = Request(tokens, max_tokens, temperature, top_k)
+        self.waiting.put(request)
+        self.wakeup.set()
+        return request
+
+    def sample(self, logits, requests):
+        return [self.model.sample_next(logits[i:i+1].float(), r.temperature, r.top_k, self.generator).item() for i, r in enumerate(requests)]
+
+    def emit(self, request, token):
+        if request.first_token_time is None:
+            request.first_token_time = time.time()
+        request.output.append(token)
+        if len(request.output) >= request.max_tokens:
+            self.cache.free(request.slot)
+            self.free_slots.append(request.slot)
+            self.active.remove(request)
+            request.finish_time = time.time()
+            request.done.set()
+
+    def fail(self, request, error):
+        # retire a request whose forward or sampling raised, the rest of the batch and the loop carry on
+        if request.slot is not None:
+            self.cache.free(request.slot)
+            self.free_slots.append(request.slot)
+            request.slot = None
+        if request in self.active:
+            self.active.remove(request)
+        request.error = f"{type(error).__name__}: {error}"
+        request.finish_time = time.time()
+        request.done.set()
+
+    def decode(self, requests):
+        # one forward of the last token of every request, returns the (len(requests), vocab) next token logits
+        self.cache.select([r.slot for r in requests])
+        x = torch.tensor([[r.output[-1]] for r in requests], device=self.device)
+        logits, _ = self.model(x, kv_cache=self.cache)
+        return logits[:, -1, :]
+
+    @torch.no_grad()
+    def step(self):
+        # admit: prefill each new prompt into its slot, the cache then holds everything but the last sampled token
+        while self.free_slots and not self.waiting.empty():
+            request = self.waiting.get_nowait()
+            request.slot = self.free_slots.pop(0)
+            try:
+                self.cache.select([request.slot])
+                logits, _ = self.model(torch.tensor([request.tokens], device=self.device), kv_cache=self.cache)
+                self.active.append(request)
+                self.emit(request, self.sample(logits[:, -1, :], [request])[0])
+            except Exception as e:
+                self.fail(request, e)
+        if not self.active:
+            return 0
+        # decode: every running request feeds its last token, whatever its length
+        requests = list(self.active)
+        lengths = self.cache.lengths.clone()
+        rows = []
+        try:
+            rows = list(zip(requests, self.decode(requests)))
+        except Exception:
+            # roll the lengths back (stale cache entries get overwritten) and retry row by row,
+            # so only the requests that fail on their own are retired
+            self.cache.lengths.copy_(lengths)
+            for request in requests:
+                try:
+                    rows.append((request, self.decode([request])[0]))
+                except Exception as e:
+                    self.fail(request, e)
+        for request, logits in rows:
+            try:
+                token = self.sample(logits[None], [request])[0]
+            except Exception as e:
+                self.fail(request, e)
+                continue
+            self.emit(request, token)
+        self.num_steps += 1
+        self.num_rows += len(requests)
+        return len(requests)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.active and self.waiting.empty():
+                self.wakeup.wait(timeout=0.1)
+                self.wakeup.clear()
+                continue
+            self.step()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def complete(engine, enc, body):
+    # blocking completion of one json request body, called from a front end thread
+    tokens = body["tokens"] if "tokens" in body else enc.encode(body["prompt"])
+    request = engine.submit(tokens, body.get("max_tokens", 64), body.get("temperature", 1.0), body.get("top_k"))
+    request.done.wait()
+    if request.error is not None:
+        raise RuntimeError(request.error)
+    return {
+        "text": enc.decode(request.output),
+        "tokens": request.output,
+        "ttft": request.first_token_time - request.arrival_time,
+        "latency": request.finish_time - request.arrival_time,
+    }
+
+def serve_http(engine, enc, host, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, reply = 200, complete(engine, enc, body)
+            except (AssertionError, KeyError, ValueError, TypeError) as e:
+                status, reply = 400, {"error": str(e)}
+            except RuntimeError as e:
+                status, reply = 500, {"error": str(e)}
+            data = json.dumps(reply).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving on http://{host}:{port}", file=sys.stderr)
+    server.serve_forever()
+
+def serve_stdin(engine, enc):
+    # one request per line, a json body or a bare prompt, replies are printed as they finish
+    lock = threading.Lock()
+    def handle(i, line):
+        try:
+            reply = complete(engine, enc, json.loads(line) if line.startswith("{") else {"prompt": line})
+        except (AssertionError, KeyError, ValueError, TypeError, RuntimeError) as e:
+            reply = {"error": str(e)}
+        with lock:
+            print(json.dumps({"id": i, **reply}), flush=True)
+    threads = []
+    for i, line in enumerate(sys.stdin):
+        line = line.strip()
+        if line:
+            threads.append(threading.Thread(target=handle, args=(i, line)))
+            threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+if __name__ == "__main__":
+    import argparse
+    import tiktoken
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True, help="checkpoint file or directory, log_dir, or gpt2 variant name")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max_batch", type=int, default=16, help="concurrent sequences in the running batch")
+    parser.add_argument("--max_len", type=int, default=0, help="prompt + generated tokens per sequence, 0 for block_size")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--stdin", action="store_true", help="read json lines from stdin instead of serving http")
+    parser.add_argument("--int8", action="store_true", help="serve with weight-only int8 quantized linears")
+    args = parser.parse_args()
+
+    model = load_model(args.checkpoint, args.device)
+    if args.int8:
+        from quantize import quantize_model
+        model = quantize_model(model)
+    engine = Engine(model, max_batch=args.max_batch, max_len=args.max_len or None, device=args.device).start()
+    enc = tiktoken.get_encoding("gpt2")
+    try:
+        if args.stdin:
+            serve_stdin(engine, enc)
+        else:
+            serve_http(engine, enc, args.host, args.port)
+    finally:
+        engine.close()